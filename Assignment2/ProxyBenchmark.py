@@ -0,0 +1,147 @@
+"""
+Author: Everett Guyea
+Date: 18-10-2026
+
+Cache-hit benchmark for ProxyServer.py. Serves one large object through the
+proxy, first with disk hits read into memory (--no-sendfile) and then with
+sendfile, and reports throughput and the proxy's peak resident memory.
+"""
+
+from socket import *
+import argparse
+import http.server
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ProxyServer cache-hit throughput and memory")
+    parser.add_argument("--size", type=int, default=64, help="object size in MiB (default 64)")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent clients (default 8)")
+    parser.add_argument("--requests", type=int, default=10, help="requests per client (default 10)")
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix="proxybench-")
+    try:
+        benchmark(workDir, args)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def benchmark(workDir, args):
+    objectPath = os.path.join(workDir, "object.bin")
+    with open(objectPath, "wb") as objectFile:
+        for _ in range(args.size):
+            objectFile.write(os.urandom(1024 * 1024))
+    # an old Last-Modified keeps the object fresh for the whole run
+    os.utime(objectPath, (time.time() - 365 * 86400,) * 2)
+
+    originPort = startOrigin(workDir)
+    url = f"http://127.0.0.1:{originPort}/object.bin"
+    proxyScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ProxyServer.py")
+
+    print(f"{args.size} MiB object, {args.clients} clients x {args.requests} hits\n")
+    print(f"{'mode':<10}{'MiB/s':>10}{'req/s':>10}{'peak RSS MiB':>15}")
+    for mode, flags in (("read", ["--no-sendfile"]), ("sendfile", [])):
+        result = runMode(proxyScript, flags, url, args, os.path.join(workDir, mode))
+        print(f"{mode:<10}{result['mibPerSec']:>10.1f}{result['reqPerSec']:>10.1f}{result['peakRssMiB']:>15.1f}")
+
+
+# Helper function to serve the work directory from a background thread
+def startOrigin(directory):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def freePort():
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def runMode(proxyScript, flags, url, args, cwd):
+    os.makedirs(cwd)
+    port = freePort()
+    proxy = subprocess.Popen([sys.executable, proxyScript, "127.0.0.1", "--port", str(port)] + flags,
+                             cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        waitForPort(port)
+        # the first request is the miss that fills the cache
+        fetch(port, url)
+
+        received = [0] * args.clients
+        start = time.time()
+        threads = [threading.Thread(target=client, args=(port, url, args.requests, received, i))
+                   for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+
+        return {
+            "mibPerSec": sum(received) / elapsed / (1024 * 1024),
+            "reqPerSec": args.clients * args.requests / elapsed,
+            "peakRssMiB": peakRss(proxy.pid) / 1024,
+        }
+    finally:
+        proxy.kill()
+        proxy.wait()
+
+
+def waitForPort(port):
+    for _ in range(100):
+        try:
+            create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("proxy did not start")
+
+
+def client(port, url, count, received, index):
+    for _ in range(count):
+        received[index] += fetch(port, url)
+
+
+# Helper function to GET url through the proxy and return the bytes received
+def fetch(port, url):
+    sock = create_connection(("127.0.0.1", port))
+    sock.sendall(f"GET {url} HTTP/1.0\r\n\r\n".encode())
+    buffer = bytearray(1024 * 1024)
+    total = 0
+    while True:
+        n = sock.recv_into(buffer)
+        if not n:
+            break
+        total += n
+    sock.close()
+    return total
+
+
+# Helper function to read the high-water mark of resident memory, in KiB
+def peakRss(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+if __name__ == "__main__":
+    main()
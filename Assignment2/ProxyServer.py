@@ -4,127 +4,2410 @@ Date: 29-10-2025
 """
 
 from socket import *
-import sys
+import socket as socket_module
+from collections import OrderedDict, deque
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+import argparse
+import asyncio
+import contextlib
+import email.utils
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
 import os
+import re
+import shutil
+import signal
+import time
+import zlib
+
+
+log = logging.getLogger("proxy")
 
 
 def main():
-    # set server hostname
-    try:
-        if len(sys.argv) < 2:
-            print("Usage: ProxyServer.py <serverHost>")
-            sys.exit(1)
-        serverHost = sys.argv[1]
-    except IndexError:
-        print("Usage: ProxyServer.py <serverHost>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Caching HTTP proxy server")
+    parser.add_argument("serverHost", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8888, help="port to listen on (default 8888)")
+    parser.add_argument("--max-connections", type=int, default=1024,
+                        help="max clients served at once; further connections wait in the backlog")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen() backlog size")
+    parser.add_argument("--memory-cache", type=int, default=64 * 1024 * 1024,
+                        help="byte budget of the in-memory hot cache (default 64 MiB, 0 disables it)")
+    parser.add_argument("--memory-object-limit", type=int, default=1024 * 1024,
+                        help="largest object kept in the hot cache (default 1 MiB)")
+    parser.add_argument("--disk-quota", type=int, default=1024 * 1024 * 1024,
+                        help="total bytes allowed in cache/ before cold entries are evicted (default 1 GiB)")
+    parser.add_argument("--client-idle-timeout", type=float, default=15,
+                        help="seconds an idle keep-alive client connection is kept open (default 15)")
+    parser.add_argument("--max-header-bytes", type=int, default=64 * 1024,
+                        help="largest request line plus headers accepted from a client (default 64 KiB)")
+    parser.add_argument("--upstream-per-host", type=int, default=8,
+                        help="max simultaneous connections to one origin (default 8)")
+    parser.add_argument("--upstream-idle-timeout", type=float, default=30,
+                        help="seconds an idle origin connection is kept for reuse (default 30)")
+    parser.add_argument("--dns-ttl", type=float, default=60,
+                        help="seconds a resolved origin address is reused (default 60)")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="read disk hits into memory instead of using sendfile (for comparison)")
+    parser.add_argument("--range-chunk", type=int, default=1024 * 1024,
+                        help="bytes fetched from the origin per Range request when filling a "
+                             "partially cached object (default 1 MiB)")
+    parser.add_argument("--gzip-level", type=int, default=6, choices=range(10),
+                        help="compression level for text the origin sent uncompressed before it is "
+                             "cached (default 6, 0 stores it as received)")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="fetch the same-origin images, scripts and stylesheets of cached HTML "
+                             "pages in the background")
+    parser.add_argument("--prefetch-workers", type=int, default=8,
+                        help="prefetches running at once (default 8)")
+    parser.add_argument("--prefetch-depth", type=int, default=2,
+                        help="links to follow from the page a client asked for; 2 also covers what "
+                             "its stylesheets load (default 2)")
+    parser.add_argument("--prefetch-per-origin", type=int, default=4,
+                        help="prefetches to one origin at once, leaving its other connections to "
+                             "clients (default 4)")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="log cache, origin and latency stats every N seconds (default off)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of proxy processes sharing the port and the cache (default 1)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG logs every request (default INFO)")
+    args = parser.parse_args()
 
-    # set server port
-    serverPort = 8888
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s [%(process)d] %(message)s")
 
     # check for cache directory
     if not os.path.exists("cache"):
         # create directory if DNE
         os.makedirs("cache")
+    # recover the cache once, before any worker starts using it
+    prepareCacheDir("cache")
 
-    # set up TCP socket to listen for connections
+    if args.workers > 1:
+        runWorkers(args)
+    else:
+        runWorker(args)
+
+
+def stopServer(signum, frame):
+    raise KeyboardInterrupt
+
+
+# Helper function to run one proxy process until it is stopped
+def runWorker(args, listenSocket=None):
+    cache = ProxyCache("cache", args.memory_cache, args.memory_object_limit, args.disk_quota,
+                       not args.no_sendfile, shared=args.workers > 1)
+    metrics = Metrics()
+
+    # stop the same way on kill as on Ctrl+C so the index gets compacted
+    signal.signal(signal.SIGTERM, stopServer)
+
+    try:
+        asyncio.run(serve(args, cache, metrics, listenSocket))
+    except KeyboardInterrupt:
+        log.info("Proxy server stopped")
+        log.info(cache.formatStats())
+        log.info(metrics.formatStats())
+    finally:
+        # a second signal must not interrupt writing the index
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        cache.close()
+
+
+# A worker that exits sooner than this after being started is restarted only
+# after a delay that doubles each time, up to MAX_RESTART_DELAY seconds
+MIN_WORKER_UPTIME = 2
+MAX_RESTART_DELAY = 30
+
+
+# Helper function to fork the worker processes and keep them running. Each
+# worker binds its own SO_REUSEPORT socket so the kernel spreads connections
+# across them; without SO_REUSEPORT they all accept from one inherited socket
+def runWorkers(args):
+    if hasattr(socket_module, "SO_REUSEPORT"):
+        # bind once here so a port that is in use fails now instead of in every worker
+        makeListenSocket(args).close()
+        listenSocket = None
+    else:
+        listenSocket = makeListenSocket(args)
+
+    # pid -> when that worker was started
+    workers = {}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                # Ctrl+C reaches the whole process group; the parent forwards it as SIGTERM
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                runWorker(args, listenSocket)
+            except BaseException:
+                log.exception("Worker failed")
+                status = 1
+            finally:
+                os._exit(status)
+        workers[pid] = time.monotonic()
+
+    signal.signal(signal.SIGTERM, stopServer)
+    try:
+        for _ in range(args.workers):
+            spawn()
+        log.info("Started %d workers: %s", args.workers, sorted(workers))
+        delay = 0
+        while True:
+            pid, status = os.wait()
+            started = workers.pop(pid, None)
+            code = os.waitstatus_to_exitcode(status)
+            if started is not None and time.monotonic() - started < MIN_WORKER_UPTIME:
+                # it died on startup; restarting it straight away would only spin
+                delay = min(max(delay * 2, 1), MAX_RESTART_DELAY)
+                log.warning("Worker %d exited with code %d right after starting, restarting it in %d seconds",
+                            pid, code, delay)
+                time.sleep(delay)
+                # the others may have died while we slept; that time is not uptime
+                for other in workers:
+                    workers[other] += delay
+            else:
+                delay = 0
+                log.warning("Worker %d exited with code %d, restarting it", pid, code)
+            spawn()
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        log.info("Proxy server stopped")
+
+
+def makeListenSocket(args):
     proxySocket = socket(AF_INET, SOCK_STREAM)
-    proxySocket.bind((serverHost, serverPort))
-    proxySocket.listen(5)
+    proxySocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if args.workers > 1 and hasattr(socket_module, "SO_REUSEPORT"):
+        proxySocket.setsockopt(SOL_SOCKET, socket_module.SO_REUSEPORT, 1)
+    proxySocket.bind((args.serverHost, args.port))
+    proxySocket.listen(args.backlog)
+    return proxySocket
 
-    print("Proxy server running... Press Ctrl+C to stop.")
 
-    while True:
-        print("Ready to serve...\n")
-        clientSocket, clientAddress = proxySocket.accept()
-        print(f"Received a connection from: {clientAddress}\n")
+# Helper function to recover the cache directory after a previous run: drop
+# abandoned downloads and the old flat layout, and verify and compact the index
+def prepareCacheDir(directory):
+    tmpDir = os.path.join(directory, ".tmp")
+    os.makedirs(tmpDir, exist_ok=True)
+    for name in os.listdir(tmpDir):
+        os.remove(os.path.join(tmpDir, name))
 
-        handleRequest(clientSocket)
+    # earlier versions kept <host>_<path> files directly in the directory,
+    # some with metadata in .meta/; they cannot be mapped back to urls
+    # reliably. Bodies now live in subdirectories, so any other top-level file
+    # (including an index rewrite cut short) is left over and goes too
+    metaDir = os.path.join(directory, ".meta")
+    if os.path.isdir(metaDir):
+        shutil.rmtree(metaDir, ignore_errors=True)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name not in ("index.log", "index.log.lock") and os.path.isfile(path) and not os.path.islink(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
+    index = CacheIndex(os.path.join(directory, "index.log"))
+    entries = OrderedDict()
+    for url, record in index.load().items():
+        # drop entries whose body did not survive (crash between writes); a
+        # partial body is sparse and always has the length of the whole object
+        partial = record["meta"].get("partial")
+        try:
+            if os.path.getsize(bodyPathFor(directory, url)) == (partial["length"] if partial else record["size"]):
+                entries[url] = record
+        except OSError:
+            pass
+    index.compact(entries)
+    index.close()
 
-# Helper function to handle the client request
-def handleRequest(clientSocket):
-    request = clientSocket.recv(4096).decode()
-    print(f"Raw request:\n{request}")
 
-    # split request into method and address
-    if "http://" not in request:
-        clientSocket.close()
-        return
-    requestParts = request.split("http://")
-    method = requestParts[0].strip()
-    address = requestParts[1].strip()
+def bodyPathFor(directory, url):
+    digest = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(directory, digest[:2], digest[2:4], digest)
+
+
+class HotCache:
+    """In-memory LRU of whole cached objects, bounded by a total byte budget."""
+
+    def __init__(self, maxBytes, maxObjectBytes):
+        self.maxBytes = maxBytes
+        self.maxObjectBytes = min(maxObjectBytes, maxBytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size):
+        if size > self.maxObjectBytes:
+            return
+        self.discard(key)
+        self.entries[key] = (value, size)
+        self.size += size
+        # drop least recently used objects until we are back under budget
+        while self.size > self.maxBytes:
+            _, (_, oldSize) = self.entries.popitem(last=False)
+            self.size -= oldSize
+            self.evictions += 1
+
+    def discard(self, key):
+        item = self.entries.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+
+class CacheIndex:
+    """Append-only journal of the disk cache, shared by every worker.
+
+    Each line is a JSON record: a "put" with the url, body size and response
+    metadata, or a "del". Replaying it rebuilds the whole index without
+    touching the cache directory. Workers append under an exclusive flock and
+    pick up each other's records by reading from where they last stopped.
+    compact() rewrites the journal with one "put" per live entry, least
+    recently used first; it replaces the file, which readers notice by its
+    inode changing and answer by replaying the new file from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lockPath = path + ".lock"
+        self.records = 0
+        self.journal = None
+        self.inode = None
+        self.offset = 0
+
+    def openJournal(self):
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.path, "a+b")
+        self.inode = os.fstat(self.journal.fileno()).st_ino
+        self.offset = 0
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(self.lockPath, "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def load(self):
+        # replay the whole journal
+        self.openJournal()
+        entries = OrderedDict()
+        records = self.readNew()
+        for record in records:
+            apply(entries, record)
+        self.records = len(records)
+        return entries
+
+    def replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def readNew(self):
+        # only complete lines are consumed; a record being written stays for next time
+        self.journal.seek(self.offset)
+        data = self.journal.read()
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a torn line from a crash
+                continue
+        return records
+
+    def append(self, record):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        # opened per write so it always goes to the current file, even right
+        # after another worker replaced it
+        with self.lock():
+            with open(self.path, "ab") as journal:
+                journal.write(line)
+        self.records += 1
+
+    def compact(self, entries):
+        tmpPath = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmpPath, "w") as journal:
+            for record in entries.values():
+                journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmpPath, self.path)
+        self.openJournal()
+        self.offset = os.path.getsize(self.path)
+        self.records = len(entries)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+# Helper function to apply one journal record to an index
+def apply(entries, record):
+    entries.pop(record["url"], None)
+    if record["op"] == "put":
+        entries[record["url"]] = record
+
+
+class DiskCache:
+    """Content-addressed object store under the cache directory.
+
+    A body lives at <directory>/ab/cd/<sha256 of the url>, so any url maps to a
+    safe, fixed-length filename and no directory grows too large. The index
+    in memory maps url -> {size, meta} in LRU order. It is kept on disk as a
+    CacheIndex journal, so lookups, eviction and stats never scan the
+    directory. With shared set, other processes write to the same cache, and
+    sync() folds their changes into this index.
+    """
+
+    def __init__(self, directory, maxBytes, shared=False):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.shared = shared
+        self.pid = os.getpid()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # urls other workers changed since the owner last looked, and whether
+        # the whole index had to be replayed
+        self.changed = []
+        self.reloaded = False
+        self.tmpDir = os.path.join(directory, ".tmp")
+        self.index = CacheIndex(os.path.join(directory, "index.log"))
+        self.reload()
+
+    def reload(self):
+        self.entries = self.index.load()
+        self.size = sum(record["size"] for record in self.entries.values())
+        self.reloaded = True
+
+    def sync(self):
+        if not self.shared:
+            return
+        if self.index.replaced():
+            self.reload()
+            return
+        for record in self.index.readNew():
+            # our own records are already applied
+            if record.get("pid") == self.pid:
+                continue
+            self.size -= self.entries.get(record["url"], {"size": 0})["size"]
+            apply(self.entries, record)
+            if record["op"] == "put":
+                self.size += record["size"]
+            self.changed.append(record["url"])
+            self.index.records += 1
+
+    def bodyPath(self, url):
+        return bodyPathFor(self.directory, url)
+
+    def get(self, url):
+        record = self.entries.get(url)
+        if record is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(url)
+        self.hits += 1
+        return record
+
+    def add(self, url, tmpPath, size, meta):
+        # tmpPath is None when a partial body was filled in place
+        if tmpPath is not None:
+            path = self.bodyPath(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # the rename is atomic, so a reader only ever opens a complete body
+            os.replace(tmpPath, path)
+        self.size -= self.entries.pop(url, {"size": 0})["size"]
+        self.putRecord(url, size, meta)
+        self.size += size
+        return self.evict(keep=url)
+
+    def update(self, url, meta):
+        record = self.entries.get(url)
+        if record is not None:
+            self.putRecord(url, record["size"], meta)
+
+    def putRecord(self, url, size, meta):
+        record = {"op": "put", "url": url, "size": size, "meta": meta, "pid": self.pid}
+        self.entries[url] = record
+        self.entries.move_to_end(url)
+        self.index.append(record)
+        self.compactIfNeeded()
+
+    def remove(self, url):
+        record = self.entries.pop(url, None)
+        if record is None:
+            return
+        self.size -= record["size"]
+        self.index.append({"op": "del", "url": url, "pid": self.pid})
+        try:
+            os.remove(self.bodyPath(url))
+        except OSError:
+            pass
+        self.compactIfNeeded()
+
+    def compactIfNeeded(self):
+        # keep the journal within a small multiple of the live entries
+        if self.index.records > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def compact(self):
+        # catch up with the other workers first so none of their records are lost
+        with self.index.lock():
+            self.sync()
+            self.index.compact(self.entries)
+
+    def evict(self, keep=None):
+        evicted = []
+        while self.size > self.maxBytes and self.entries:
+            url = next(iter(self.entries))
+            if url == keep:
+                break
+            self.remove(url)
+            self.evictions += 1
+            evicted.append(url)
+        return evicted
+
+    def close(self):
+        # persist the current LRU order for the next run
+        self.compact()
+        self.index.close()
+
+
+class ProxyCache:
+    """Hot objects in memory in front of the on-disk cache directory.
+
+    Entries are keyed by url and looked up as (meta, body) pairs: meta holds
+    the origin status line, headers and freshness info, and is kept in the
+    disk index. body is None for objects too big for the hot tier; those are
+    sent straight from bodyPath(url) with sendfile instead of being read into
+    memory.
+
+    An object filled by origin Range requests is kept as a partial entry: its
+    body is a sparse file of the full length and meta["partial"] lists which
+    chunks of it are there. Only Range requests are answered from it, and it
+    turns into a normal entry once the last chunk arrives.
+    """
+
+    def __init__(self, directory, memoryBytes, memoryObjectBytes, diskBytes, useSendfile=True, shared=False):
+        self.memory = HotCache(memoryBytes, memoryObjectBytes)
+        self.disk = DiskCache(directory, diskBytes, shared)
+        self.useSendfile = useSendfile
+        self.tmpCounter = itertools.count()
+        self.sync()
+
+    def lookup(self, url):
+        entry = self.memory.get(url)
+        if entry is not None:
+            return entry
+        record = self.disk.get(url)
+        if record is None and self.disk.shared:
+            # another worker may have fetched it since we last looked
+            self.sync()
+            record = self.disk.get(url)
+        if record is None:
+            return None
+        meta, body = record["meta"], None
+        if "partial" in meta:
+            return meta, None
+        if record["size"] <= self.memory.maxObjectBytes or not self.useSendfile:
+            try:
+                with open(self.bodyPath(url), "rb") as cachedFile:
+                    body = cachedFile.read()
+            except OSError:
+                # removed behind our back, treat it as a miss
+                self.disk.remove(url)
+                return None
+            self.memory.put(url, (meta, body), len(body))
+        return meta, body
+
+    def sync(self):
+        self.disk.sync()
+        if self.disk.reloaded:
+            # the journal was compacted and replayed; keep only hot copies that are still current
+            for url, (meta, _) in list(self.memory.entries.items()):
+                record = self.disk.entries.get(url)
+                if record is None or record["meta"]["storedAt"] != meta["storedAt"]:
+                    self.memory.discard(url)
+            self.disk.reloaded = False
+        for url in self.disk.changed:
+            self.memory.discard(url)
+        self.disk.changed = []
+        for evicted in self.disk.evict():
+            self.memory.discard(evicted)
+
+    def bodyPath(self, url):
+        return self.disk.bodyPath(url)
+
+    def tempPath(self, url):
+        # unique across workers as well as within this one
+        digest = os.path.basename(self.bodyPath(url))
+        return os.path.join(self.disk.tmpDir, f"{digest}.{os.getpid()}.{next(self.tmpCounter)}")
+
+    def store(self, url, tmpPath, meta, size, body=None):
+        # the body was streamed to tmpPath and is renamed into place. body is
+        # only passed when the object is small enough for the hot tier
+        for evicted in self.disk.add(url, tmpPath, size, meta):
+            self.memory.discard(evicted)
+        if body is not None:
+            self.memory.put(url, (meta, body), size)
+        else:
+            self.memory.discard(url)
+
+    def storeChunk(self, url, meta, index, tmpPath):
+        # a chunk from an origin Range request is copied into the partial body
+        # at its offset; meta describes the object the chunk belongs to
+        self.sync()
+        record = self.disk.entries.get(url)
+        target = self.bodyPath(url)
+        if record is not None and "partial" not in record["meta"]:
+            # the whole object was cached meanwhile
+            os.remove(tmpPath)
+            return
+        if record is not None and samePartial(record["meta"], meta) and os.path.exists(target):
+            meta = record["meta"]
+            newBody = None
+        else:
+            # first chunk of this version: start a sparse body of the full length
+            newBody = target = self.tempPath(url)
+            with open(target, "wb") as body:
+                body.truncate(meta["partial"]["length"])
+        length, chunkBytes = meta["partial"]["length"], meta["partial"]["chunkBytes"]
+        copyChunk(tmpPath, target, index * chunkBytes)
+        os.remove(tmpPath)
+
+        chunks = sorted(set(meta["partial"]["chunks"]) | {index})
+        size = sum(min(chunkBytes, length - i * chunkBytes) for i in chunks)
+        if size == length:
+            meta = {key: value for key, value in meta.items() if key != "partial"}
+        else:
+            meta = dict(meta, partial=dict(meta["partial"], chunks=chunks))
+        for evicted in self.disk.add(url, newBody, size, meta):
+            self.memory.discard(evicted)
+        self.memory.discard(url)
+
+    def holds(self, url, meta, index):
+        # whether chunk index of the object meta describes can come from disk
+        record = self.disk.entries.get(url)
+        if record is None or rangeValidator(meta) is None or not sameObject(record["meta"], meta):
+            return False
+        partial = record["meta"].get("partial")
+        if partial is not None and (partial["chunkBytes"] != meta["partial"]["chunkBytes"]
+                                    or index not in partial["chunks"]):
+            return False
+        self.disk.entries.move_to_end(url)
+        return True
+
+    def peek(self, url):
+        # like lookup, but counts no hit or miss and never reads a body from disk
+        item = self.memory.entries.get(url)
+        if item is not None:
+            return item[0]
+        record = self.disk.entries.get(url)
+        if record is None or "partial" in record["meta"]:
+            return None
+        return record["meta"], None
+
+    def refresh(self, url, meta, body):
+        # a 304 only changes the metadata
+        self.disk.update(url, meta)
+        if body is not None:
+            self.memory.put(url, (meta, body), len(body))
+
+    def remove(self, url):
+        self.memory.discard(url)
+        self.disk.remove(url)
+
+    def close(self):
+        self.disk.close()
+
+    def stats(self):
+        return {
+            "memoryHits": self.memory.hits,
+            "memoryMisses": self.memory.misses,
+            "memoryEvictions": self.memory.evictions,
+            "memoryBytes": self.memory.size,
+            "memoryObjects": len(self.memory.entries),
+            "diskHits": self.disk.hits,
+            "diskMisses": self.disk.misses,
+            "diskEvictions": self.disk.evictions,
+            "diskBytes": self.disk.size,
+            "diskObjects": len(self.disk.entries),
+            "indexRecords": self.disk.index.records,
+        }
+
+    def formatStats(self):
+        return "Cache stats: " + ", ".join(f"{k}={v}" for k, v in self.stats().items())
+
+
+# headers that only apply to a single connection and are never cached or forwarded
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "te",
+              "trailer", "upgrade", "proxy-authenticate", "proxy-authorization"}
+
+
+# Helper function to split a response head into its status line and header list
+def parseHead(head):
+    lines = head.decode("iso-8859-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers.append([name.strip(), value.strip()])
+    return lines[0], headers
+
+
+def getHeader(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def statusCode(statusLine):
+    try:
+        return int(statusLine.split()[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def parseCacheControl(value):
+    directives = {}
+    for part in (value or "").split(","):
+        key, _, arg = part.strip().partition("=")
+        if key:
+            directives[key.strip().lower()] = arg.strip().strip('"')
+    return directives
+
+
+def parseHttpDate(value):
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def isCacheable(status, headers):
+    directives = parseCacheControl(getHeader(headers, "Cache-Control"))
+    return status == 200 and "no-store" not in directives and "private" not in directives
+
+
+# Helper function to work out how old a response already was when it reached
+# us: the larger of the Age caches before us added and how far Date is behind
+def initialAge(headers, now):
+    try:
+        age = max(0, int(getHeader(headers, "Age") or 0))
+    except ValueError:
+        age = 0
+    date = parseHttpDate(getHeader(headers, "Date"))
+    if date is not None:
+        age = max(age, now - date)
+    return age
+
+
+# Helper function to work out until when a response may be served without revalidating
+def freshUntil(headers, now):
+    directives = parseCacheControl(getHeader(headers, "Cache-Control"))
+    if "no-cache" in directives:
+        return now
+    # the freshness lifetime counts from when the origin made the response
+    age = initialAge(headers, now)
+    for name in ("s-maxage", "max-age"):
+        if name in directives:
+            try:
+                return now + max(0, int(directives[name]) - age)
+            except ValueError:
+                return now
+
+    date = parseHttpDate(getHeader(headers, "Date")) or now
+    expires = getHeader(headers, "Expires")
+    if expires is not None:
+        # an unparseable Expires means already expired
+        expiresAt = parseHttpDate(expires)
+        return now + max(0, expiresAt - date - age) if expiresAt is not None else now
+
+    # heuristic freshness: 10% of the time since the last change, capped at a day
+    lastModified = parseHttpDate(getHeader(headers, "Last-Modified"))
+    if lastModified is not None:
+        return now + min(max(0, date - lastModified) / 10, 86400)
+    return now
+
+
+def buildMeta(url, statusLine, headers, now):
+    # Age is recomputed whenever the copy is served, from initialAge and storedAt
+    stored = [h for h in headers if h[0].lower() not in HOP_BY_HOP and h[0].lower() != "age"]
+    return {
+        "url": url,
+        "status": statusLine,
+        "headers": stored,
+        "storedAt": now,
+        "initialAge": initialAge(headers, now),
+        "expiresAt": freshUntil(headers, now),
+        "etag": getHeader(headers, "ETag"),
+        "lastModified": getHeader(headers, "Last-Modified"),
+    }
+
+
+# Helper function to fold the headers of a 304 into the stored metadata
+def revalidatedMeta(meta, headers, now):
+    updated = {h[0].lower(): h for h in headers if h[0].lower() not in HOP_BY_HOP}
+    merged = []
+    for name, value in meta["headers"]:
+        if name.lower() not in updated:
+            merged.append([name, value])
+    merged.extend(updated.values())
+    revalidated = buildMeta(meta["url"], meta["status"], merged, now)
+    # the stored body is unchanged, and so is how it is encoded
+    for key in ("encoding", "identityLength"):
+        if key in meta:
+            revalidated[key] = meta[key]
+    return revalidated
+
+
+# content types worth compressing; images, video and archives already are
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/x-javascript", "application/json",
+                      "application/xml", "application/xhtml+xml", "image/svg+xml")
+# bodies smaller than this gain nothing from gzip once its header is added
+MIN_GZIP_BYTES = 256
+
+
+# Helper function to decide whether to gzip a plain response before caching it
+def shouldCompress(headers):
+    if getHeader(headers, "Content-Encoding") is not None:
+        return False
+    if "no-transform" in parseCacheControl(getHeader(headers, "Cache-Control")):
+        return False
+    length = getHeader(headers, "Content-Length")
+    if length is not None and length.isdigit() and int(length) < MIN_GZIP_BYTES:
+        return False
+    contentType = (getHeader(headers, "Content-Type") or "").split(";")[0].strip().lower()
+    return contentType.startswith(COMPRESSIBLE_TYPES) or contentType.endswith(("+xml", "+json"))
+
+
+# Helper function to tell whether a client takes gzip: named in its
+# Accept-Encoding, or covered by *, with a q above zero
+def acceptsGzip(request):
+    value = request.header("Accept-Encoding") if request is not None else None
+    if not value:
+        return False
+    weights = {}
+    for part in value.split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        weight = 1.0
+        for param in params:
+            key, _, arg = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(arg)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in weights:
+            return weights[coding] > 0
+    return False
+
+
+# Helper function to work out the headers a client gets for a body that is
+# stored with the given encoding, and whether it has to be decompressed for
+# it. headers are the origin's; identityLength is the uncompressed size
+def representation(headers, encoding, identityLength, gzipOk):
+    if encoding is None:
+        return headers, False
+    originEncoded = getHeader(headers, "Content-Encoding") is not None
+    vary = getHeader(headers, "Vary")
+    result = []
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered == "vary":
+            continue
+        if lowered in ("content-length", "content-encoding") and (not gzipOk or not originEncoded):
+            continue
+        if lowered == "etag" and gzipOk and not originEncoded and not value.startswith("W/"):
+            # our gzip bytes are not the bytes the origin's strong ETag names
+            value = "W/" + value
+        result.append([name, value])
+    if vary is None:
+        result.append(["Vary", "Accept-Encoding"])
+    elif "accept-encoding" not in vary.lower() and vary.strip() != "*":
+        result.append(["Vary", vary + ", Accept-Encoding"])
+    else:
+        result.append(["Vary", vary])
+    if gzipOk and not originEncoded:
+        result.append(["Content-Encoding", "gzip"])
+    if not gzipOk and identityLength is not None:
+        result.append(["Content-Length", str(identityLength)])
+    return result, not gzipOk
+
+
+# Helper function to decompress one piece of a gzip stream, yielding the output
+# a bit at a time so a small piece that inflates hugely never sits in memory
+def decodePieces(decoder, data):
+    while data:
+        piece = decoder.decompress(data, 256 * 1024)
+        if piece:
+            yield piece
+        data = decoder.unconsumed_tail
+
+
+# Helper function to build the metadata of a partially cached object from the
+# head of a 206, as if it described the whole 200 response
+def partialMeta(url, statusLine, headers, length, chunkBytes, now):
+    whole = [h for h in headers if h[0].lower() not in ("content-range", "content-length")]
+    whole.append(["Content-Length", str(length)])
+    meta = buildMeta(url, statusLine.split()[0] + " 200 OK", whole, now)
+    meta["partial"] = {"length": length, "chunkBytes": chunkBytes, "chunks": []}
+    return meta
+
+
+# Helper function to pick the validator to send in If-Range: a strong ETag,
+# or else Last-Modified; None when the object has neither
+def rangeValidator(meta):
+    etag = meta["etag"]
+    if etag and not etag.startswith("W/"):
+        return etag
+    return meta["lastModified"]
+
+
+def objectLength(meta):
+    if "partial" in meta:
+        return meta["partial"]["length"]
+    try:
+        return int(getHeader(meta["headers"], "Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Helper function to tell whether two metas describe the same version of an object
+def sameObject(meta, other):
+    return (objectLength(meta) is not None and objectLength(meta) == objectLength(other)
+            and meta["etag"] == other["etag"] and meta["lastModified"] == other["lastModified"])
+
+
+def samePartial(meta, other):
+    return ("partial" in meta and meta["partial"]["chunkBytes"] == other["partial"]["chunkBytes"]
+            and sameObject(meta, other))
+
+
+# Helper function to copy a downloaded chunk into a body file at its offset
+def copyChunk(srcPath, dstPath, offset):
+    with open(srcPath, "rb") as src, open(dstPath, "r+b") as dst:
+        dst.seek(offset)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+# more ranges than this in one request are ignored and the whole object is sent
+MAX_RANGES = 64
+
+
+# Helper function to parse a Range header into (first, last) pairs, where a
+# first of None means the last `last` bytes; None when it is not one we honour
+def parseRange(value):
+    unit, _, spec = (value or "").partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    specs = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        try:
+            first = int(first) if first.strip() else None
+            last = int(last) if last.strip() else None
+        except ValueError:
+            return None
+        if not dash or first is None and last is None:
+            return None
+        if first is not None and last is not None and last < first or (last or 0) < 0:
+            return None
+        specs.append((first, last))
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    return specs
+
+
+# Helper function to turn parsed specs into (start, end) byte ranges of an
+# object of the given length, in the order they were asked for, merging any
+# that overlap or touch; an empty list means none of them can be satisfied
+def resolveRanges(specs, length):
+    ranges = []
+    for first, last in specs:
+        if first is None:
+            if last == 0:
+                continue
+            start, end = max(0, length - last), length - 1
+        elif first >= length:
+            continue
+        else:
+            start, end = first, length - 1 if last is None else min(last, length - 1)
+        ranges.append((start, end))
+    merged = []
+    for start, end in ranges:
+        # a merged range takes the place of the first part it absorbed
+        touching = [i for i, (low, high) in enumerate(merged) if low <= end + 1 and start <= high + 1]
+        for i in touching:
+            start, end = min(start, merged[i][0]), max(end, merged[i][1])
+        if touching:
+            merged[touching[0]] = (start, end)
+            for i in reversed(touching[1:]):
+                del merged[i]
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Helper function to work out which bytes of a 200 to send a client: None for
+# the whole object, otherwise the ranges it asked for (empty: unsatisfiable)
+def requestedRanges(request, meta, length):
+    # a compressed copy is only ever sent whole
+    if request is None or statusCode(meta["status"]) != 200 or "encoding" in meta:
+        return None
+    specs = parseRange(request.header("Range"))
+    if specs is None:
+        return None
+    # If-Range: send ranges only if the client's copy is still the current one
+    ifRange = request.header("If-Range")
+    if ifRange is not None and ifRange != rangeValidator(meta):
+        return None
+    return resolveRanges(specs, length)
+
+
+def parseContentRange(value):
+    unit, _, spec = (value or "").partition(" ")
+    span, _, total = spec.partition("/")
+    first, _, last = span.partition("-")
+    if unit.lower() != "bytes":
+        return None
+    try:
+        return int(first), int(last), int(total)
+    except ValueError:
+        return None
+
+
+# Helper function to render a response head for the client. The status line
+# carries the proxy's own version, not the origin's: framing and connection
+# handling are ours, and an HTTP/1.0 line must not go out with chunked bodies
+def buildHead(statusLine, headers, contentLength=None, extra=(), keepAlive=False):
+    lines = ["HTTP/1.1 " + statusLine.partition(" ")[2]]
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered in HOP_BY_HOP or (contentLength is not None and lowered == "content-length"):
+            continue
+        lines.append(f"{name}: {value}")
+    if contentLength is not None:
+        lines.append(f"Content-Length: {contentLength}")
+    lines.extend(extra)
+    lines.append("Connection: keep-alive" if keepAlive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+# Helper function to work out the Age of a cached copy: how old it was when
+# stored plus how long it has been in the cache
+def currentAge(meta):
+    return int(meta.get("initialAge", 0) + max(0, time.time() - meta["storedAt"]))
+
+
+# Helper function to answer from the cache; returns the body bytes sent.
+# With request given, a Range in it is answered with just those bytes, and a
+# compressed copy goes out as it is if the client takes gzip
+async def sendCached(writer, path, meta, body, keepAlive=False, request=None):
+    extra = [f"Age: {currentAge(meta)}"]
+    headers, decode = representation(meta["headers"], meta.get("encoding"), meta.get("identityLength"),
+                                     acceptsGzip(request))
+    if decode:
+        head = buildHead(meta["status"], headers, meta["identityLength"], extra, keepAlive)
+        decoder = zlib.decompressobj(31)
+        if body is not None:
+            writer.write(head)
+            for piece in decodePieces(decoder, body):
+                writer.write(piece)
+                await writer.drain()
+            return meta["identityLength"]
+        # open first: if another worker evicted the body it is still a miss
+        with open(path, "rb") as cachedFile:
+            writer.write(head)
+            while True:
+                data = cachedFile.read(65536)
+                if not data:
+                    break
+                for piece in decodePieces(decoder, data):
+                    writer.write(piece)
+                    await writer.drain()
+        return meta["identityLength"]
+
+    if "encoding" not in meta and getHeader(headers, "Accept-Ranges") is None and statusCode(meta["status"]) == 200:
+        extra.append("Accept-Ranges: bytes")
+    if body is not None:
+        ranges = requestedRanges(request, meta, len(body))
+        if ranges is None:
+            writer.write(buildHead(meta["status"], headers, len(body), extra, keepAlive))
+            writer.write(body)
+            await writer.drain()
+            return len(body)
+
+        async def sendPart(start, end):
+            writer.write(memoryview(body)[start:end + 1])
+            await writer.drain()
+            return True
+        return await sendRanges(writer, meta, len(body), ranges, sendPart, keepAlive)
+
+    # large objects go from the page cache to the socket without passing
+    # through Python, so memory stays flat whatever the object size
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as cachedFile:
+        size = os.fstat(cachedFile.fileno()).st_size
+        ranges = requestedRanges(request, meta, size)
+        if ranges is None:
+            writer.write(buildHead(meta["status"], headers, size, extra, keepAlive))
+            await loop.sendfile(writer.transport, cachedFile, 0, size)
+            return size
+
+        async def sendPart(start, end):
+            await loop.sendfile(writer.transport, cachedFile, start, end - start + 1)
+            return True
+        return await sendRanges(writer, meta, size, ranges, sendPart, keepAlive)
+
+
+# Helper function to answer a Range request for an object of the given
+# length: 416 when no range fits, one 206 part, or several as
+# multipart/byteranges. sendPart(start, end) writes those bytes of the body
+# and returns False if it could not; the result is the body bytes sent, or
+# None when the response was cut short
+async def sendRanges(writer, meta, length, ranges, sendPart, keepAlive=False):
+    if not ranges:
+        body = "416 Range Not Satisfiable"
+        writer.write(buildHead(f"HTTP/1.1 {body}", [["Content-Type", "text/plain"]], len(body),
+                               [f"Content-Range: bytes */{length}"], keepAlive) + body.encode())
+        await writer.drain()
+        return 0
+
+    statusLine = "HTTP/1.1 206 Partial Content"
+    age = f"Age: {currentAge(meta)}"
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        writer.write(buildHead(statusLine, meta["headers"], end - start + 1,
+                               [f"Content-Range: bytes {start}-{end}/{length}", age], keepAlive))
+        if not await sendPart(start, end):
+            return None
+        return end - start + 1
+
+    boundary = os.urandom(12).hex()
+    contentType = getHeader(meta["headers"], "Content-Type")
+    partHeads = []
+    for start, end in ranges:
+        partHead = f"\r\n--{boundary}\r\n"
+        if contentType is not None:
+            partHead += f"Content-Type: {contentType}\r\n"
+        partHeads.append((partHead + f"Content-Range: bytes {start}-{end}/{length}\r\n\r\n").encode("iso-8859-1"))
+    closing = f"\r\n--{boundary}--\r\n".encode()
+    total = sum(len(partHead) for partHead in partHeads) + len(closing)
+    total += sum(end - start + 1 for start, end in ranges)
+
+    headers = [h for h in meta["headers"] if h[0].lower() != "content-type"]
+    headers.append(["Content-Type", f"multipart/byteranges; boundary={boundary}"])
+    writer.write(buildHead(statusLine, headers, total, [age], keepAlive))
+    for partHead, (start, end) in zip(partHeads, ranges):
+        writer.write(partHead)
+        if not await sendPart(start, end):
+            return None
+    writer.write(closing)
+    await writer.drain()
+    return total
+
+
+async def sendError(writer, status, reason, keepAlive=False):
+    body = f"{status} {reason}"
+    head = buildHead(f"HTTP/1.1 {status} {reason}", [["Content-Type", "text/plain"]], len(body), keepAlive=keepAlive)
+    writer.write(head + body.encode())
+    await writer.drain()
+
+
+class RequestError(Exception):
+    """A client request we cannot parse; status is the HTTP error to answer with."""
+
+    def __init__(self, status, reason):
+        super().__init__(f"{status} {reason}")
+        self.status = status
+        self.reason = reason
 
-    # Check for GET method
-    if method != "GET":
-        error = f"HTTP/1.0 405 Method Not Allowed\r\nContent-Type: text/plain\r\ncontent-Length: 22\r\n\r\n405 Method Not Allowed"
-        clientSocket.sendall(error.encode())
-        clientSocket.close()
-        return
 
-    # remove HTTP ver.
-    address = address.split()[0]
+class Request:
+    """One parsed client request."""
 
-    # split host:port from path by splitting at the first '/'
-    address = address.split("/", 1)
-    hostPort = address[0]
-    path = "/" + address[1] if len(address) > 1 else "/"
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def header(self, name):
+        return getHeader(self.headers, name)
+
+    def keepAlive(self):
+        # browsers talking to a proxy often send Proxy-Connection instead
+        connection = (self.header("Connection") or self.header("Proxy-Connection") or "").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+
+class RequestParser:
+    """Incremental HTTP/1.x request parser.
+
+    feed() takes bytes as they arrive from the client, in whatever pieces
+    the network delivers them, and appends every complete request to
+    self.requests. Pipelined requests in one read come out in order, and a
+    head split across several reads waits in the buffer until it is whole.
+    """
+
+    def __init__(self, maxHeaderBytes, maxBodyBytes=1024 * 1024):
+        self.maxHeaderBytes = maxHeaderBytes
+        self.maxBodyBytes = maxBodyBytes
+        self.buffer = bytearray()
+        self.requests = deque()
+        self.scanned = 0
+        self.pending = None
+
+    def feed(self, data):
+        self.buffer += data
+        while self.parseOne():
+            pass
+
+    def parseOne(self):
+        if self.pending is None:
+            # tolerate stray blank lines between pipelined requests
+            while self.buffer[:2] == b"\r\n":
+                del self.buffer[:2]
+            end = self.buffer.find(b"\r\n\r\n", max(0, self.scanned - 3))
+            if end < 0:
+                self.scanned = len(self.buffer)
+                if len(self.buffer) > self.maxHeaderBytes:
+                    raise RequestError(431, "Request Header Fields Too Large")
+                return False
+            if end + 4 > self.maxHeaderBytes:
+                raise RequestError(431, "Request Header Fields Too Large")
+            head = bytes(self.buffer[:end])
+            del self.buffer[:end + 4]
+            self.scanned = 0
+            self.pending = self.parseHead(head)
+
+        request, length = self.pending
+        if len(self.buffer) < length:
+            return False
+        request.body = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.pending = None
+        self.requests.append(request)
+        return True
+
+    def parseHead(self, head):
+        lines = head.decode("iso-8859-1").split("\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise RequestError(400, "Bad Request")
+        headers = []
+        for line in lines[1:]:
+            if ":" not in line:
+                raise RequestError(400, "Bad Request")
+            name, value = line.split(":", 1)
+            headers.append([name.strip(), value.strip()])
+        request = Request(parts[0], parts[1], parts[2], headers, b"")
+
+        if request.header("Transfer-Encoding") is not None:
+            raise RequestError(501, "Not Implemented")
+        try:
+            length = int(request.header("Content-Length") or 0)
+        except ValueError:
+            raise RequestError(400, "Bad Request")
+        if length < 0:
+            raise RequestError(400, "Bad Request")
+        if length > self.maxBodyBytes:
+            raise RequestError(413, "Payload Too Large")
+        return request, length
+
+
+# Helper function to pull host, port and path out of a proxy request target
+def parseTarget(request):
+    target = request.target
+    if target.startswith("http://"):
+        address = target[len("http://"):].split("/", 1)
+        hostPort = address[0]
+        path = "/" + address[1] if len(address) > 1 else "/"
+    elif target.startswith("/") and request.header("Host"):
+        # origin-form, e.g. when used as a transparent proxy
+        hostPort = request.header("Host")
+        path = target
+    else:
+        raise RequestError(400, "Bad Request")
 
     # check for specified port #
     if ":" in hostPort:
-        host, port = hostPort.split(":")
-        port = int(port)
+        host, port = hostPort.rsplit(":", 1)
+        try:
+            port = int(port)
+        except ValueError:
+            raise RequestError(400, "Bad Request")
     else:
         host = hostPort
         port = 80
+    if not host:
+        raise RequestError(400, "Bad Request")
+    return host, port, path
 
-    if port != 80:
-        hostWPort = f"{host}_{port}"
-    else:
-        hostWPort = host
 
-    print(f"Extracted:\nHost: {host}, Port:{port}, Path: {path}")
+class DnsCache:
+    """Remembers resolved origin addresses for a few seconds so repeat misses skip the lookup.
 
-    filepath = "cache/" + hostWPort + path.replace("/", "_")
-    if os.path.exists(filepath):
-        print("<<< CACHE HIT >>>")
-        with open(filepath, "rb") as cachedFile:
-            data = cachedFile.read()
-            clientSocket.sendall(data)
-            print(f"Served from Local Cache: {filepath}")
-    else:
-        print("<<< CACHE MISS >>>")
+    Holds at most maxEntries origins; the least recently used one is dropped
+    when a new origin would go over that, and expired entries are dropped as
+    they are found.
+    """
+
+    def __init__(self, ttl, maxEntries=256):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        cached = self.entries.get(key)
+        if cached is not None:
+            if cached[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            del self.entries[key]
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(host, port, type=SOCK_STREAM)
+        address = infos[0][4][0]
+        self.entries[key] = (address, now + self.ttl)
+        self.entries.move_to_end(key)
+        # drop expired entries from the old end, then the least recently used
+        while self.entries:
+            oldest, (_, expiry) = next(iter(self.entries.items()))
+            if expiry > now and len(self.entries) <= self.maxEntries:
+                break
+            del self.entries[oldest]
+        return address
+
+
+class UpstreamConnection:
+    """One origin connection plus when it was last handed back to the pool."""
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.lastUsed = time.monotonic()
+        self.requests = 0
+
+
+class UpstreamPool:
+    """Keep-alive connections to origin servers, keyed by (host, port).
+
+    At most perHost connections to one origin are in use at a time; further
+    fetches wait for one to be released. Idle connections are closed after
+    idleTimeout seconds.
+    """
+
+    def __init__(self, perHost, idleTimeout, dns, metrics):
+        self.perHost = perHost
+        self.idleTimeout = idleTimeout
+        self.dns = dns
+        self.metrics = metrics
+        self.idle = {}
+        self.limits = {}
+        self.users = {}
+        self.opened = 0
+        self.reused = 0
+        self.reaper = None
+
+    async def acquire(self, host, port, fresh=False):
+        key = (host, port)
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = asyncio.Semaphore(self.perHost)
+        # count waiters too, so reapIdle never drops a semaphore someone is queued on
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            await limit.acquire()
+        except BaseException:
+            self.dropUser(key)
+            raise
+        try:
+            if not fresh:
+                conn = self.takeIdle(key)
+                if conn is not None:
+                    self.reused += 1
+                    return conn
+            start = time.monotonic()
+            address = await self.dns.resolve(host, port)
+            reader, writer = await asyncio.open_connection(address, port)
+            self.metrics.record("originConnect", time.monotonic() - start)
+            self.opened += 1
+            return UpstreamConnection(key, reader, writer)
+        except BaseException:
+            limit.release()
+            self.dropUser(key)
+            raise
+
+    def dropUser(self, key):
+        left = self.users[key] - 1
+        if left:
+            self.users[key] = left
+        else:
+            del self.users[key]
+
+    def takeIdle(self, key):
+        idle = self.idle.get(key)
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            # skip connections the origin has closed or that sat too long
+            if conn.reader.at_eof() or conn.writer.is_closing() or now - conn.lastUsed > self.idleTimeout:
+                conn.writer.close()
+                continue
+            return conn
+        return None
+
+    def release(self, conn, reusable):
+        self.limits[conn.key].release()
+        self.dropUser(conn.key)
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.reapIdle())
+        if not reusable:
+            conn.writer.close()
+            return
+        conn.lastUsed = time.monotonic()
+        conn.requests += 1
+        self.idle.setdefault(conn.key, []).append(conn)
+
+    async def reapIdle(self):
+        while True:
+            await asyncio.sleep(max(self.idleTimeout / 2, 0.5))
+            cutoff = time.monotonic() - self.idleTimeout
+            for key, idle in list(self.idle.items()):
+                keep = []
+                for conn in idle:
+                    if conn.lastUsed < cutoff or conn.reader.at_eof():
+                        conn.writer.close()
+                    else:
+                        keep.append(conn)
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+            # forget the per-origin limit once nothing holds, waits on or parks a connection
+            for key in list(self.limits):
+                if key not in self.users and key not in self.idle:
+                    del self.limits[key]
+
+
+class Flight:
+    """One in-progress origin fetch that any number of clients can stream from.
+
+    The body is written to the temp file behind fd as it arrives; size is how
+    much of it is there so far. Clients read through the shared fd with pread,
+    so it does not matter if the file gets renamed into the cache or deleted
+    while they are still reading. waiters counts the clients attached to the
+    flight; the fd is closed once the fetch is done and all of them have left.
+
+    A chunk flight fetches one chunk of url with a Range request. Its file
+    then holds the object's bytes from start on, length is the size of the
+    whole object and meta describes it, as taken from the 206.
+
+    encoding is "gzip" when the file holds the body gzipped, whether the
+    origin sent it that way or we are compressing it; identityLength is then
+    the uncompressed size if it is known up front.
+    """
+
+    def __init__(self, url, chunk=None):
+        self.key = url if chunk is None else (url, chunk)
+        self.url = url
+        self.chunk = chunk
+        self.start = 0
+        self.length = None
+        self.meta = None
+        self.encoding = None
+        self.identityLength = None
+        self.tmpPath = None
+        self.fd = None
+        self.statusLine = None
+        self.headers = None
+        self.entry = None
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.task = None
+        self.updated = asyncio.Event()
+
+    def notify(self):
+        updated, self.updated = self.updated, asyncio.Event()
+        updated.set()
+
+    async def wait(self):
+        await self.updated.wait()
+
+    def leave(self):
+        self.waiters -= 1
+        self.closeIfUnused()
+
+    def finish(self):
+        self.done = True
+        self.notify()
+        self.closeIfUnused()
+
+    def closeIfUnused(self):
+        if self.done and self.waiters == 0 and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class OriginFetcher:
+    """Fetches objects from origin servers, collapsing concurrent misses on the same key."""
+
+    def __init__(self, cache, pool, metrics, chunkBytes, gzipLevel=6):
+        self.cache = cache
+        self.pool = pool
+        self.metrics = metrics
+        self.chunkBytes = chunkBytes
+        self.gzipLevel = gzipLevel
+        self.inflight = {}
+        self.collapsed = 0
+        self.chunkFetches = 0
+        # told about every object stored, when prefetching is on
+        self.prefetcher = None
+
+    def fetch(self, url, host, port, path, entry, chunk=None):
+        # with chunk, fetch only that chunk of the object; entry is then the
+        # partial copy the chunk is for, if any
+        key = url if chunk is None else (url, chunk)
+        flight = self.inflight.get(key)
+        if flight is not None:
+            self.collapsed += 1
+        else:
+            flight = Flight(url, chunk)
+            self.inflight[key] = flight
+            self.chunkFetches += chunk is not None
+            flight.task = asyncio.create_task(self.run(flight, host, port, path, entry))
+        flight.waiters += 1
+        return flight
+
+    async def run(self, flight, host, port, path, entry):
+        conn = None
+        reusable = False
         try:
-            print("Connecting to Server...\n")
-            # connect to server
-            serverSocket = socket(AF_INET, SOCK_STREAM)
-            serverSocket.connect((host, port))
-            print(f"Connection successful to {host}:{port}")
-
-            # GET request for server
-            GETReq = f"GET {path} HTTP/1.0\r\nHost: {host}\r\nConnection: close\r\nUser-Agent: SimpleProxy/1.0\r\n\r\n"
-            serverSocket.sendall(GETReq.encode())
-
-            # response
-            with open(filepath, "wb") as cacheFile:
-                while True:
-                    data = serverSocket.recv(4096)
-                    if not data:
-                        break
-                    clientSocket.sendall(data)
-                    cacheFile.write(data)
-
-            size = os.path.getsize(filepath)
-            print(f"Saved {size} bytes to cache")
-            serverSocket.close()
+            # GET request for server, conditional when we hold a stale copy
+            hostHeader = host if port == 80 else f"{host}:{port}"
+            GETReq = f"GET {path} HTTP/1.1\r\nHost: {hostHeader}\r\nUser-Agent: SimpleProxy/1.0\r\n"
+            if flight.chunk is not None:
+                # chunks are byte ranges of the plain object, so never compressed
+                first = flight.chunk * self.chunkBytes
+                GETReq += f"Range: bytes={first}-{first + self.chunkBytes - 1}\r\nAccept-Encoding: identity\r\n"
+                # a changed object comes back whole instead of as a mismatched chunk
+                if entry is not None and rangeValidator(entry[0]) is not None:
+                    GETReq += f"If-Range: {rangeValidator(entry[0])}\r\n"
+            else:
+                # whatever the client takes, it is cached compressed and
+                # decompressed on the way out for clients without gzip
+                GETReq += "Accept-Encoding: gzip\r\n"
+            if flight.chunk is None and entry is not None:
+                if entry[0]["etag"]:
+                    GETReq += f"If-None-Match: {entry[0]['etag']}\r\n"
+                if entry[0]["lastModified"]:
+                    GETReq += f"If-Modified-Since: {entry[0]['lastModified']}\r\n"
+            GETReq = (GETReq + "\r\n").encode()
+
+            conn, head = await self.sendRequest(host, port, GETReq)
+            statusLine, headers = parseHead(head)
+            status = statusCode(statusLine)
+            now = time.time()
+
+            if status == 304 and entry is not None and flight.chunk is None:
+                log.debug("revalidated url=%s", flight.url)
+                self.metrics.count("revalidated")
+                reusable = keepAlive(statusLine, headers)
+                meta, body = entry
+                meta = revalidatedMeta(meta, headers, now)
+                self.cache.refresh(flight.url, meta, body)
+                flight.entry = (meta, body)
+                return
+
+            # everything goes through a temp file so late joiners can read what
+            # already arrived; only cacheable responses are renamed into the cache
+            cacheable = isCacheable(status, headers)
+            if flight.chunk is not None and status == 206:
+                contentRange = parseContentRange(getHeader(headers, "Content-Range"))
+                if contentRange is None or contentRange[0] != first:
+                    raise ValueError(f"unexpected Content-Range {getHeader(headers, 'Content-Range')!r}")
+                flight.start, flight.length = contentRange[0], contentRange[2]
+                flight.meta = partialMeta(flight.url, statusLine, headers, flight.length, self.chunkBytes, now)
+                # chunks of different versions must never be mixed, so
+                # without a validator to check them against nothing is kept
+                cacheable = isCacheable(200, headers) and rangeValidator(flight.meta) is not None
+            # the file holds the body gzipped when the origin sent it that way
+            # or when it is text we compress ourselves; identity counts the
+            # uncompressed bytes so clients without gzip get a Content-Length
+            encoder = decoder = None
+            identity = 0
+            if flight.meta is None and (getHeader(headers, "Content-Encoding") or "").lower() == "gzip":
+                flight.encoding = "gzip"
+                decoder = zlib.decompressobj(31)
+            elif cacheable and self.gzipLevel and shouldCompress(headers):
+                flight.encoding = "gzip"
+                flight.identityLength = getHeader(headers, "Content-Length")
+                encoder = zlib.compressobj(self.gzipLevel, zlib.DEFLATED, 31)
+            flight.tmpPath = self.cache.tempPath(flight.url)
+            flight.fd = os.open(flight.tmpPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            flight.statusLine = statusLine
+            flight.headers = headers
+            flight.notify()
+
+            hotCopy = bytearray() if flight.meta is None else None
+
+            def append(data):
+                nonlocal hotCopy
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(flight.fd, view):]
+                flight.size += len(data)
+                flight.notify()
+                # keep a copy for the hot tier while the object still fits in it
+                if hotCopy is not None:
+                    hotCopy += data
+                    if len(hotCopy) > self.cache.memory.maxObjectBytes:
+                        hotCopy = None
+
+            async for data in readBody(conn.reader, status, headers):
+                if decoder is not None:
+                    try:
+                        identity += sum(len(piece) for piece in decodePieces(decoder, data))
+                    except zlib.error:
+                        # clients without gzip could not be served from it
+                        log.debug("bad gzip body url=%s", flight.url)
+                        decoder = None
+                        cacheable = False
+                if encoder is not None:
+                    identity += len(data)
+                    data = encoder.compress(data)
+                if data:
+                    append(data)
+            if encoder is not None:
+                append(encoder.flush())
+            # a close-delimited body leaves nothing to reuse
+            reusable = keepAlive(statusLine, headers) and hasFraming(status, headers)
+
+            if flight.meta is not None:
+                if cacheable and flight.size == min(self.chunkBytes, flight.length - flight.start):
+                    self.cache.storeChunk(flight.url, flight.meta, flight.chunk, flight.tmpPath)
+                    log.debug("stored chunk=%d url=%s bytes=%d", flight.chunk, flight.url, flight.size)
+                else:
+                    os.remove(flight.tmpPath)
+            elif cacheable:
+                meta = buildMeta(flight.url, statusLine, headers, now)
+                if flight.encoding is not None:
+                    meta["encoding"] = flight.encoding
+                    meta["identityLength"] = identity
+                if encoder is not None:
+                    self.metrics.count("gzipped")
+                    self.metrics.count("bytesSavedByGzip", identity - flight.size)
+                self.cache.store(flight.url, flight.tmpPath, meta, flight.size,
+                                 bytes(hotCopy) if hotCopy is not None else None)
+                log.debug("stored url=%s bytes=%d encoding=%s", flight.url, flight.size, flight.encoding)
+                if self.prefetcher is not None:
+                    self.prefetcher.stored(flight.url, meta)
+            else:
+                # the origin no longer lets us keep this object; readers keep
+                # streaming from the unlinked file through the shared fd
+                log.debug("not cached url=%s status=%r", flight.url, statusLine)
+                os.remove(flight.tmpPath)
+                if entry is not None:
+                    self.cache.remove(flight.url)
         except Exception as e:
-            print("Error fetching from origin:", e)
-            error = "HTTP/1.0 502 Bad Gateway\r\nContent-Type: text/plain\r\nContent-Length: 15\r\n\r\n502 Bad Gateway"
-            clientSocket.sendall(error.encode())
+            log.warning("Error fetching %s from origin: %s", flight.url, e)
+            self.metrics.count("originErrors")
+            flight.error = e
+            # never leave a partial download behind
+            if flight.tmpPath is not None:
+                try:
+                    os.remove(flight.tmpPath)
+                except OSError:
+                    pass
+        finally:
+            if conn is not None:
+                self.pool.release(conn, reusable)
+            del self.inflight[flight.key]
+            flight.finish()
+
+    # Helper function to send a request and read the response head, retrying
+    # once on a fresh connection if a pooled one turns out to be dead
+    async def sendRequest(self, host, port, request):
+        conn = await self.pool.acquire(host, port)
+        for attempt in range(2):
+            reused = conn.requests > 0
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                head = await conn.reader.readuntil(b"\r\n\r\n")
+                return conn, head
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.pool.release(conn, False)
+                if not reused or attempt:
+                    raise
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+            conn = await self.pool.acquire(host, port, fresh=True)
+
+    def stats(self):
+        stats = {
+            "collapsed": self.collapsed,
+            "inflight": len(self.inflight),
+            "chunkFetches": self.chunkFetches,
+            "connectionsOpened": self.pool.opened,
+            "connectionsReused": self.pool.reused,
+            "dnsHits": self.pool.dns.hits,
+            "dnsMisses": self.pool.dns.misses,
+        }
+        if self.prefetcher is not None:
+            stats.update(self.prefetcher.counters)
+        return stats
+
+    def formatStats(self):
+        return "Origin stats: " + ", ".join(f"{k}={v}" for k, v in self.stats().items())
+
+
+# largest page, after decompressing, that is scanned for links
+MAX_SCAN_BYTES = 2 * 1024 * 1024
+# seconds a url found on a page is not queued again
+PREFETCH_MEMORY = 60
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)|@import\s+(['"])([^'"]+)\3""", re.IGNORECASE)
+
+
+class LinkParser(HTMLParser):
+    """Collects what an HTML page loads as it renders: scripts, stylesheets, images and frames."""
+
+    SOURCES = {("img", "src"), ("script", "src"), ("iframe", "src"), ("frame", "src"), ("embed", "src"),
+               ("source", "src"), ("audio", "src"), ("video", "src"), ("video", "poster"),
+               ("track", "src"), ("input", "src")}
+    LINK_RELS = {"stylesheet", "icon", "preload", "modulepreload", "apple-touch-icon"}
+
+    def __init__(self):
+        super().__init__()
+        self.base = None
+        self.urls = []
+        self.inStyle = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value for name, value in attrs if value}
+        if tag == "base" and self.base is None:
+            self.base = attrs.get("href")
+        elif tag == "link" and set(attrs.get("rel", "").lower().split()) & self.LINK_RELS:
+            self.urls.append(attrs.get("href"))
+        elif tag == "style":
+            self.inStyle = True
+        for name, value in attrs.items():
+            if (tag, name) in self.SOURCES:
+                self.urls.append(value)
+            elif name == "srcset":
+                # "a.png 1x, b.png 2x"
+                self.urls.extend(candidate.split()[0] for candidate in value.split(",") if candidate.strip())
+            elif name == "style":
+                self.urls.extend(cssUrls(value))
+
+    def handle_endtag(self, tag):
+        if tag == "style":
+            self.inStyle = False
+
+    def handle_data(self, data):
+        if self.inStyle:
+            self.urls.extend(cssUrls(data))
+
+
+def cssUrls(text):
+    return [match.group(2) or match.group(4) for match in CSS_URL.finditer(text)]
+
+
+def contentType(meta):
+    return (getHeader(meta["headers"], "Content-Type") or "").split(";")[0].strip().lower()
+
+
+# Helper function to resolve a link on the page at url to the proxy's cache
+# key and (host, port, path); None unless it is http on the same host and port
+def sameOriginTarget(url, base, ref):
+    try:
+        resolved = urlsplit(urljoin(base, ref.strip()))
+        page = urlsplit(url)
+        port = resolved.port or 80
+    except ValueError:
+        return None
+    if resolved.scheme != "http" or resolved.hostname != page.hostname or port != (page.port or 80):
+        return None
+    host = page.netloc.rsplit(":", 1)[0]
+    path = resolved.path or "/"
+    if resolved.query:
+        path += "?" + resolved.query
+    return f"http://{host}:{port}{path}", (host, port, path)
+
+
+class Prefetcher:
+    """Warms the cache with the subresources of HTML pages as they are cached.
+
+    Whenever the fetcher stores a page, or a stylesheet a page pulled in,
+    its body is scanned for same-origin scripts, stylesheets, images and
+    frames, and those are fetched in the background through the same
+    OriginFetcher, so the browser's follow-up requests hit the cache or join
+    a fetch already in flight. A fixed number of worker tasks share one
+    bounded queue (a full queue drops new work), at most perOrigin of them
+    fetch from one origin at a time, and nothing more than maxDepth links
+    from the page a client asked for is fetched.
+    """
+
+    def __init__(self, cache, fetcher, workers, maxDepth, perOrigin, maxQueued=1000):
+        self.cache = cache
+        self.fetcher = fetcher
+        self.workers = workers
+        self.maxDepth = maxDepth
+        self.perOrigin = perOrigin
+        self.queue = asyncio.Queue(maxQueued)
+        self.limits = {}
+        self.users = {}
+        # depth of each url being prefetched, so its own links go one level deeper
+        self.depths = {}
+        # url -> when it was last queued
+        self.recent = OrderedDict()
+        self.counters = dict.fromkeys(("prefetchScanned", "prefetchQueued", "prefetchFetched",
+                                       "prefetchAlreadyCached", "prefetchDropped", "prefetchErrors"), 0)
+
+    def start(self):
+        return [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    def stored(self, url, meta):
+        depth = self.depths.get(url, 0)
+        if depth < self.maxDepth and contentType(meta) in ("text/html", "application/xhtml+xml", "text/css"):
+            self.put((url, depth, None))
+
+    def put(self, job):
+        try:
+            self.queue.put_nowait(job)
+            return True
+        except asyncio.QueueFull:
+            self.counters["prefetchDropped"] += 1
+            return False
+
+    async def work(self):
+        while True:
+            url, depth, target = await self.queue.get()
+            try:
+                if target is None:
+                    self.scan(url, depth)
+                else:
+                    await self.prefetch(url, target, depth)
+            except Exception as e:
+                log.debug("prefetch failed url=%s error=%s", url, e)
+                self.counters["prefetchErrors"] += 1
+
+    def scan(self, url, depth):
+        entry = self.cache.peek(url)
+        if entry is None:
+            return
+        meta, body = entry
+        if body is None:
+            with open(self.cache.bodyPath(url), "rb") as cachedFile:
+                body = cachedFile.read(MAX_SCAN_BYTES + 1)
+        if meta.get("encoding") == "gzip":
+            body = zlib.decompressobj(31).decompress(body, MAX_SCAN_BYTES + 1)
+        if len(body) > MAX_SCAN_BYTES:
+            return
+        text = body.decode("utf-8", "replace")
+        self.counters["prefetchScanned"] += 1
+
+        base = url
+        if contentType(meta) == "text/css":
+            refs = cssUrls(text)
+        else:
+            parser = LinkParser()
+            parser.feed(text)
+            parser.close()
+            refs = parser.urls
+            if parser.base:
+                base = urljoin(url, parser.base)
+
+        now = time.monotonic()
+        while self.recent and next(iter(self.recent.values())) < now - PREFETCH_MEMORY:
+            self.recent.popitem(last=False)
+        for ref in refs:
+            found = sameOriginTarget(url, base, ref) if ref else None
+            if found is None or found[0] in self.recent or found[0] == url:
+                continue
+            if self.put((found[0], depth + 1, found[1])):
+                self.recent[found[0]] = now
+                self.counters["prefetchQueued"] += 1
+
+    async def prefetch(self, url, target, depth):
+        entry = self.cache.peek(url)
+        if entry is not None and entry[0]["expiresAt"] > time.time():
+            self.counters["prefetchAlreadyCached"] += 1
+            return
+        host, port, path = target
+        key = (host, port)
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = asyncio.Semaphore(self.perOrigin)
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            async with limit:
+                self.depths[url] = depth
+                flight = self.fetcher.fetch(url, host, port, path, entry)
+                try:
+                    while not flight.done:
+                        await flight.wait()
+                finally:
+                    flight.leave()
+                    self.depths.pop(url, None)
+        finally:
+            # the last prefetch for an origin takes its limit with it
+            self.users[key] -= 1
+            if not self.users[key]:
+                del self.users[key]
+                del self.limits[key]
+        if flight.error is None:
+            self.counters["prefetchFetched"] += 1
+            log.debug("prefetched url=%s depth=%d", url, depth)
+        else:
+            self.counters["prefetchErrors"] += 1
+
+
+class RangeSource:
+    """Sends byte ranges of an object that is not wholly in the cache.
+
+    Given a flight for the whole object (the origin ignored our Range, or a
+    stale copy is being refetched), any byte is sent as soon as the download
+    reaches it. Otherwise the object is read in chunks: chunks already held
+    on disk come from the body file, and each missing one is fetched with
+    its own Range request and streamed to the client while it arrives. Chunk
+    fetches go through the fetcher, so clients after the same chunk share
+    one request and the first bytes of a large object go out long before the
+    rest of it has been downloaded.
+    """
+
+    def __init__(self, url, target, cache, fetcher, metrics, meta=None):
+        self.url = url
+        self.target = target
+        self.cache = cache
+        self.fetcher = fetcher
+        self.metrics = metrics
+        self.meta = meta
+        self.length = objectLength(meta) if meta is not None else None
+        self.flight = None
+        # chunk flights joined before the response started, by chunk index
+        self.primed = {}
+
+    def adopt(self, flight):
+        # take the object's meta and length from the flight a miss started;
+        # False when its response cannot be served in ranges
+        status = statusCode(flight.statusLine)
+        if flight.meta is not None and status == 206:
+            self.meta, self.length = flight.meta, flight.length
+            flight.waiters += 1
+            self.primed[flight.chunk] = flight
+            return True
+        length = getHeader(flight.headers, "Content-Length")
+        if status != 200 or length is None or getHeader(flight.headers, "Transfer-Encoding") is not None:
+            return False
+        if flight.encoding is not None:
+            # the file holds gzip bytes, which the client's ranges do not refer to
+            return False
+        self.meta = buildMeta(flight.url, flight.statusLine, flight.headers, time.time())
+        self.length = int(length)
+        self.flight = flight
+        return True
+
+    # Helper function to answer a Range request; returns whether the
+    # connection can stay open, or None when it should get the plain response
+    async def answer(self, writer, request, keepAlive, flight=None):
+        try:
+            if flight is not None and not self.adopt(flight):
+                return None
+            ranges = requestedRanges(request, self.meta, self.length)
+            if ranges is None:
+                if self.flight is not None:
+                    return None
+                # send the whole object, from the chunks we have and those we fetch
+                writer.write(buildHead(self.meta["status"], self.meta["headers"], self.length, keepAlive=keepAlive))
+                return keepAlive if await self.sendPart(writer, 0, self.length - 1) else False
+            sent = await sendRanges(writer, self.meta, self.length, ranges,
+                                    lambda start, end: self.sendPart(writer, start, end), keepAlive)
+            return keepAlive if sent is not None else False
+        finally:
+            for primed in self.primed.values():
+                primed.leave()
+            self.primed.clear()
+
+    async def sendPart(self, writer, start, end):
+        if self.flight is not None:
+            return await self.relay(writer, self.flight, start, end)
+        chunkBytes = self.meta["partial"]["chunkBytes"]
+        while start <= end:
+            index = start // chunkBytes
+            stop = min(end, (index + 1) * chunkBytes - 1)
+            if not await self.sendChunk(writer, index, start, stop):
+                return False
+            start = stop + 1
+        return True
+
+    async def sendChunk(self, writer, index, start, end):
+        flight = self.primed.pop(index, None)
+        if flight is None:
+            if self.cache.holds(self.url, self.meta, index):
+                try:
+                    with open(self.cache.bodyPath(self.url), "rb") as cachedFile:
+                        await asyncio.get_running_loop().sendfile(writer.transport, cachedFile,
+                                                                  start, end - start + 1)
+                    self.metrics.count("bytesFromCache", end - start + 1)
+                    return True
+                except FileNotFoundError:
+                    # evicted since we looked; fetch it again
+                    pass
+            host, port, path = self.target
+            flight = self.fetcher.fetch(self.url, host, port, path, (self.meta, None), index)
+        try:
+            while flight.statusLine is None and not flight.done:
+                await flight.wait()
+            if flight.meta is None or not sameObject(flight.meta, self.meta):
+                # the object changed part way through our response
+                log.debug("range source changed url=%s chunk=%d", self.url, index)
+                return False
+            return await self.relay(writer, flight, start, end)
+        finally:
+            flight.leave()
+
+    async def relay(self, writer, flight, start, end):
+        # send bytes start..end of the object as the flight downloads them
+        while start <= end:
+            have = flight.start + flight.size
+            if start < have:
+                data = os.pread(flight.fd, min(65536, end + 1 - start, have - start), start - flight.start)
+                writer.write(data)
+                await writer.drain()
+                start += len(data)
+                self.metrics.count("bytesFromOrigin", len(data))
+            elif flight.done:
+                log.debug("origin fetch failed url=%s error=%s", flight.url, flight.error)
+                return False
+            else:
+                await flight.wait()
+        return True
+
+
+def keepAlive(statusLine, headers):
+    connection = (getHeader(headers, "Connection") or "").lower()
+    if statusLine.startswith("HTTP/1.0"):
+        return "keep-alive" in connection
+    return "close" not in connection
+
+
+def hasFraming(status, headers):
+    if status in (204, 304) or 100 <= status < 200:
+        return True
+    encoding = (getHeader(headers, "Transfer-Encoding") or "").lower()
+    return "chunked" in encoding or getHeader(headers, "Content-Length") is not None
+
+
+# Helper function to yield a response body using Content-Length, chunked
+# encoding, or read-until-close framing
+async def readBody(reader, status, headers):
+    if status in (204, 304) or 100 <= status < 200:
+        return
+
+    encoding = (getHeader(headers, "Transfer-Encoding") or "").lower()
+    if "chunked" in encoding:
+        while True:
+            sizeLine = await reader.readuntil(b"\r\n")
+            size = int(sizeLine.split(b";")[0].strip(), 16)
+            if size == 0:
+                # skip any trailers up to the blank line
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return
+            while size > 0:
+                data = await reader.read(min(size, 65536))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", size)
+                size -= len(data)
+                yield data
+            await reader.readexactly(2)
+
+    length = getHeader(headers, "Content-Length")
+    if length is not None:
+        remaining = int(length)
+        while remaining > 0:
+            data = await reader.read(min(remaining, 65536))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            yield data
+        return
+
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            return
+        yield data
+
+
+class Metrics:
+    """Request counters plus recent latency samples for this process.
+
+    Each latency series keeps its last maxSamples values in seconds, so the
+    percentiles describe recent traffic and memory stays bounded under load.
+    """
+
+    COUNTERS = ("requests", "hits", "misses", "stale", "revalidated", "errors", "originErrors",
+                "rangeRequests", "partialHits", "gzipped", "decompressed", "bytesSavedByGzip",
+                "bytesFromCache", "bytesFromOrigin")
+    SERIES = ("hit", "miss", "originConnect")
+
+    def __init__(self, maxSamples=10000):
+        self.started = time.time()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.samples = {name: deque(maxlen=maxSamples) for name in self.SERIES}
+        self.recorded = dict.fromkeys(self.SERIES, 0)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, series, seconds):
+        self.samples[series].append(seconds)
+        self.recorded[series] += 1
+
+    def latency(self, series):
+        samples = sorted(self.samples[series])
+        summary = {"count": self.recorded[series]}
+        for p in (50, 95, 99):
+            # nearest-rank percentile, in milliseconds
+            value = samples[max(0, -(-p * len(samples) // 100) - 1)] if samples else 0
+            summary[f"p{p}"] = round(value * 1000, 3)
+        return summary
+
+    def stats(self):
+        return {
+            "uptime": round(time.time() - self.started, 1),
+            "counters": dict(self.counters),
+            "latencyMs": {name: self.latency(name) for name in self.SERIES},
+        }
+
+    def formatStats(self):
+        parts = [f"{k}={v}" for k, v in self.counters.items()]
+        for name in self.SERIES:
+            summary = self.latency(name)
+            parts.append(f"{name}=p50:{summary['p50']}/p95:{summary['p95']}/p99:{summary['p99']}ms")
+        return "Request stats: " + ", ".join(parts)
+
+
+async def serve(args, cache, metrics, proxySocket=None):
+    # set up TCP socket to listen for connections
+    if proxySocket is None:
+        proxySocket = makeListenSocket(args)
+    proxySocket.setblocking(False)
+
+    log.info("Proxy server running on port %d... Press Ctrl+C to stop.", args.port)
+
+    loop = asyncio.get_running_loop()
+    # a slot is taken before accept(), so once max-connections clients are being
+    # served new connections stay queued in the kernel backlog (backpressure)
+    slots = asyncio.Semaphore(args.max_connections)
+    tasks = set()
+    pool = UpstreamPool(args.upstream_per_host, args.upstream_idle_timeout, DnsCache(args.dns_ttl), metrics)
+    fetcher = OriginFetcher(cache, pool, metrics, args.range_chunk, args.gzip_level)
+
+    if args.prefetch:
+        fetcher.prefetcher = Prefetcher(cache, fetcher, args.prefetch_workers, args.prefetch_depth,
+                                        args.prefetch_per_origin)
+        tasks.update(fetcher.prefetcher.start())
+    if args.stats_interval > 0:
+        tasks.add(asyncio.create_task(logStats(cache, fetcher, metrics, args.stats_interval)))
+    if cache.disk.shared:
+        tasks.add(asyncio.create_task(syncCache(cache)))
+
+    while True:
+        await slots.acquire()
+        try:
+            clientSocket, clientAddress = await loop.sock_accept(proxySocket)
+        except OSError as e:
+            slots.release()
+            log.warning("Accept failed: %s", e)
+            continue
+        log.debug("connection from=%s:%d", *clientAddress)
+
+        task = asyncio.create_task(serveClient(clientSocket, slots, cache, fetcher, metrics, args))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+# Helper function to pick up the other workers' cache changes and evictions
+async def syncCache(cache):
+    while True:
+        await asyncio.sleep(1)
+        cache.sync()
+
+
+# Helper function to log the cache, origin and request stats periodically
+async def logStats(cache, fetcher, metrics, interval):
+    while True:
+        await asyncio.sleep(interval)
+        log.info(cache.formatStats())
+        log.info(fetcher.formatStats())
+        log.info(metrics.formatStats())
+
+
+# Helper function to answer GET /__stats with this process's stats as JSON
+async def sendStats(writer, cache, fetcher, metrics, keepAlive):
+    stats = metrics.stats()
+    stats["pid"] = os.getpid()
+    stats["cache"] = cache.stats()
+    stats["origin"] = fetcher.stats()
+    body = json.dumps(stats, indent=2).encode()
+    writer.write(buildHead("HTTP/1.1 200 OK", [["Content-Type", "application/json"],
+                                               ["Cache-Control", "no-store"]], len(body), keepAlive=keepAlive))
+    writer.write(body)
+    await writer.drain()
+
+
+# Helper function to run one client connection and free its slot afterwards
+async def serveClient(clientSocket, slots, cache, fetcher, metrics, args):
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection(sock=clientSocket)
+        await handleClient(reader, writer, cache, fetcher, metrics, args)
+    except (ConnectionError, OSError) as e:
+        log.debug("client connection error: %s", e)
+    finally:
+        if writer is not None:
+            writer.close()
+        else:
             clientSocket.close()
-            serverSocket.close()
+        slots.release()
+
+
+# Helper function to answer every request a client sends on one connection,
+# in order, for as long as both sides keep it alive
+async def handleClient(reader, writer, cache, fetcher, metrics, args):
+    parser = RequestParser(args.max_header_bytes)
+    while True:
+        while not parser.requests:
+            try:
+                data = await asyncio.wait_for(reader.read(65536), args.client_idle_timeout)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
+            try:
+                parser.feed(data)
+            except RequestError as e:
+                log.debug("rejected request: %s", e)
+                metrics.count("errors")
+                await sendError(writer, e.status, e.reason)
+                return
+
+        request = parser.requests.popleft()
+        if not await handleRequest(request, writer, cache, fetcher, metrics):
+            return
+
+
+# Helper function to handle the client request; returns whether the
+# connection can stay open for the next one
+async def handleRequest(request, writer, cache, fetcher, metrics):
+    log.debug("request method=%s target=%s version=%s", request.method, request.target, request.version)
+    keepAlive = request.keepAlive()
+    start = time.monotonic()
+
+    # Check for GET method
+    if request.method != "GET":
+        metrics.count("errors")
+        await sendError(writer, 405, "Method Not Allowed", keepAlive)
+        return keepAlive
+
+    # requests for the proxy itself rather than through it
+    if request.target == "/__stats":
+        await sendStats(writer, cache, fetcher, metrics, keepAlive)
+        return keepAlive
+
+    try:
+        host, port, path = parseTarget(request)
+    except RequestError as e:
+        metrics.count("errors")
+        await sendError(writer, e.status, e.reason, keepAlive)
+        return keepAlive
+
+    metrics.count("requests")
+    url = f"http://{host}:{port}{path}"
+    entry = cache.lookup(url)
+    ranged = request.header("Range") is not None
+    if ranged:
+        metrics.count("rangeRequests")
+    if entry is not None and "partial" in entry[0]:
+        # only a Range request can be answered from part of an object
+        if ranged and entry[0]["expiresAt"] > time.time():
+            source = RangeSource(url, (host, port, path), cache, fetcher, metrics, entry[0])
+            result = await source.answer(writer, request, keepAlive)
+            if result is not None:
+                metrics.count("partialHits")
+                metrics.record("hit", time.monotonic() - start)
+                log.debug("partial hit url=%s", url)
+                return result
+        entry = None
+
+    if entry is not None and entry[0]["expiresAt"] > time.time():
+        try:
+            sent = await sendCached(writer, cache.bodyPath(url), *entry, keepAlive, request)
+            if "encoding" in entry[0] and not acceptsGzip(request):
+                metrics.count("decompressed")
+            metrics.count("hits")
+            metrics.count("bytesFromCache", sent)
+            metrics.record("hit", time.monotonic() - start)
+            log.debug("hit url=%s bytes=%d", url, sent)
+            return keepAlive
+        except FileNotFoundError:
+            # evicted by another worker after our lookup; nothing was sent yet
+            cache.remove(url)
+            entry = None
+
+    metrics.count("stale" if entry is not None else "misses")
+    specs = parseRange(request.header("Range")) if ranged else None
+    if specs is not None and entry is None:
+        # fetch just the chunk holding the first byte asked for (the start,
+        # for a suffix range) to learn the object's length and serve from there
+        chunk = (specs[0][0] or 0) // fetcher.chunkBytes
+        flight = fetcher.fetch(url, host, port, path, None, chunk)
+    else:
+        flight = fetcher.fetch(url, host, port, path, entry)
+    source = RangeSource(url, (host, port, path), cache, fetcher, metrics) if ranged else None
+    log.debug("%s url=%s waiters=%d", "stale" if entry is not None else "miss", url, flight.waiters)
+    keepAlive = await streamFlight(writer, cache, flight, metrics, keepAlive, request, source)
+    metrics.record("miss", time.monotonic() - start)
+    return keepAlive
+
+
+# Helper function to relay a flight to one client as the body arrives;
+# returns whether the connection can stay open afterwards. With source, a
+# Range request is answered with just the bytes it asked for
+async def streamFlight(writer, cache, flight, metrics, keepAlive, request, source=None):
+    try:
+        # wait for the response head (or the outcome of a revalidation)
+        while flight.statusLine is None and not flight.done:
+            await flight.wait()
+
+        if flight.entry is not None:
+            if "encoding" in flight.entry[0] and not acceptsGzip(request):
+                metrics.count("decompressed")
+            sent = await sendCached(writer, cache.bodyPath(flight.url), *flight.entry, keepAlive, request)
+            metrics.count("bytesFromCache", sent or 0)
+            return keepAlive
+        if flight.statusLine is None:
+            metrics.count("errors")
+            await sendError(writer, 502, "Bad Gateway", keepAlive)
+            return keepAlive
+        if source is not None:
+            result = await source.answer(writer, request, keepAlive, flight)
+            if result is not None:
+                return result
+
+        # the length is known up front when the origin sent one; otherwise an
+        # HTTP/1.1 client gets the body re-chunked and anyone else gets it
+        # delimited by closing the connection
+        # a gzipped body is decompressed on the way for clients without gzip
+        headers, decode = representation(flight.headers, flight.encoding, flight.identityLength, acceptsGzip(request))
+        decoder = zlib.decompressobj(31) if decode else None
+        if decode:
+            metrics.count("decompressed")
+
+        chunked = False
+        if getHeader(headers, "Content-Length") is None and statusCode(flight.statusLine) not in (204, 304):
+            chunked = keepAlive and request.version == "HTTP/1.1"
+            keepAlive = chunked
+        extra = ["Transfer-Encoding: chunked"] if chunked else []
+        writer.write(buildHead(flight.statusLine, headers, extra=extra, keepAlive=keepAlive))
+
+        sent = 0
+        while True:
+            if sent < flight.size:
+                # drain() waits on slow clients so each one reads at its own pace
+                data = os.pread(flight.fd, min(65536, flight.size - sent), sent)
+                sent += len(data)
+                metrics.count("bytesFromOrigin", len(data))
+                try:
+                    for piece in [data] if decoder is None else decodePieces(decoder, data):
+                        if chunked:
+                            writer.write(b"%x\r\n" % len(piece) + piece + b"\r\n")
+                        else:
+                            writer.write(piece)
+                        await writer.drain()
+                except zlib.error as e:
+                    # the origin sent a broken gzip body; closing tells the client it is short
+                    log.debug("cannot decompress url=%s error=%s", flight.url, e)
+                    metrics.count("errors")
+                    return False
+            elif flight.done:
+                break
+            else:
+                await flight.wait()
 
-    clientSocket.close()
+        if flight.error is not None:
+            # the origin died part way through; closing tells the client it is short
+            log.debug("origin fetch failed url=%s after=%d error=%s", flight.url, sent, flight.error)
+            metrics.count("errors")
+            return False
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return keepAlive
+    finally:
+        flight.leave()
 
 
 if __name__ == "__main__":
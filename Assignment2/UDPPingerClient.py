@@ -3,26 +3,50 @@ Author: Everett Guyea
 Date: 29-10-2025
 """
 
+import argparse
+import math
+import selectors
+import statistics
 import time
 from socket import *
-import sys
 
 
 def main():
-    if len(sys.argv) < 3:
-        print("Usage: UDPPingerClient.py <serverHost> <port>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Ping a UDPPingerServer")
+    parser.add_argument("serverHost")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--pipeline", action="store_true",
+                        help="keep many pings in flight and print statistics instead of each reply")
+    parser.add_argument("--count", type=int, default=10, help="pings per target (default 10)")
+    parser.add_argument("--rate", type=float, default=10, help="pings per second per target in --pipeline mode (default 10)")
+    parser.add_argument("--timeout", type=float, default=1.0,
+                        help="seconds to wait for a reply before counting it lost (default 1)")
+    parser.add_argument("--target", action="append", default=[], metavar="HOST[:PORT]",
+                        help="another server to ping at the same time (--pipeline); may be repeated")
+    parser.add_argument("--bins", type=int, default=10, help="RTT histogram buckets (default 10)")
+    args = parser.parse_args()
 
-    # Get hostname and port from arguments
-    serverHost = sys.argv[1]
-    serverPort = int(sys.argv[2])
+    if not args.pipeline:
+        serialPing(args.serverHost, args.port, args.count, args.timeout)
+        return
+
+    targets = [(args.serverHost, args.port)]
+    for target in args.target:
+        host, _, port = target.rpartition(":") if ":" in target else (target, "", "")
+        targets.append((host, int(port) if port else args.port))
+    probes = pipelinePing(targets, args.count, args.rate, args.timeout)
+    for probe in probes:
+        printSummary(probe, args.bins)
+
+
+def serialPing(serverHost, serverPort, count, timeoutSeconds):
     address = (serverHost, serverPort)
 
     # Create socket and set timeout
     clientSock = socket(AF_INET, SOCK_DGRAM)
-    clientSock.settimeout(1)
+    clientSock.settimeout(timeoutSeconds)
 
-    for seqNum in range(1, 11):
+    for seqNum in range(1, count + 1):
         # create ping message
         sentTime = time.time()
         printTime = time.strftime("%a %b %d %H:%M:%S %Y", time.localtime())
@@ -44,5 +68,128 @@ def main():
     clientSock.close()
 
 
+class Probe:
+    # the pings to one target: when each went out and what came back
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        # connected, so the kernel only hands us this target's replies
+        self.sock.connect((gethostbyname(host), port))
+        self.sock.setblocking(False)
+        self.sentAt = {}     # seq -> perf_counter at send
+        self.rtts = {}       # seq -> seconds
+        self.sent = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.highestSeq = 0
+        self.errors = 0
+
+    def send(self, seqNum):
+        self.sentAt[seqNum] = time.perf_counter()
+        self.sent += 1
+        try:
+            self.sock.send(f"Ping {seqNum} {time.time()}".encode())
+        except OSError:
+            self.errors += 1    # e.g. ICMP unreachable from an earlier ping
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.errors += 1
+                continue
+            now = time.perf_counter()
+            # the server echoes "PING <seq> <time>"
+            try:
+                seqNum = int(data.split()[1])
+            except (IndexError, ValueError):
+                continue
+            if seqNum not in self.sentAt:
+                continue
+            if seqNum in self.rtts:
+                self.duplicates += 1
+                continue
+            if seqNum < self.highestSeq:
+                self.reordered += 1
+            self.highestSeq = max(self.highestSeq, seqNum)
+            self.rtts[seqNum] = now - self.sentAt[seqNum]
+
+    def waiting(self):
+        return len(self.rtts) < self.sent
+
+
+def pipelinePing(targets, count, rate, timeoutSeconds):
+    # send to every target at the given rate without waiting for replies,
+    # then keep listening until each ping is answered or has timed out
+    probes = [Probe(host, port) for host, port in targets]
+    selector = selectors.DefaultSelector()
+    for probe in probes:
+        selector.register(probe.sock, selectors.EVENT_READ, probe)
+
+    interval = 1 / rate
+    start = time.perf_counter()
+    seqNum = 0
+    while seqNum < count:
+        now = time.perf_counter()
+        nextSend = start + seqNum * interval
+        if now >= nextSend:
+            seqNum += 1
+            for probe in probes:
+                probe.send(seqNum)
+            continue
+        for key, _ in selector.select(nextSend - now):
+            key.data.receive()
+
+    # the last ping gets the full timeout; earlier ones have had longer
+    lastSent = time.perf_counter()
+    while time.perf_counter() - lastSent < timeoutSeconds:
+        if not any(probe.waiting() for probe in probes):
+            break
+        for key, _ in selector.select(0.05):
+            key.data.receive()
+
+    selector.close()
+    for probe in probes:
+        probe.sock.close()
+    return probes
+
+
+def printSummary(probe, bins):
+    received = len(probe.rtts)
+    loss = 100.0 * (probe.sent - received) / probe.sent if probe.sent else 0.0
+    print(f"--- {probe.host}:{probe.port} ping statistics ---")
+    print(f"{probe.sent} sent, {received} received, {loss:.1f}% loss, "
+          f"{probe.duplicates} duplicates, {probe.reordered} reordered"
+          + (f", {probe.errors} socket errors" if probe.errors else ""))
+    if not received:
+        print()
+        return
+
+    rtts = [probe.rtts[seqNum] * 1000 for seqNum in sorted(probe.rtts)]
+    # jitter: mean change in RTT between consecutive replies, in send order
+    jitter = statistics.mean(abs(b - a) for a, b in zip(rtts, rtts[1:])) if len(rtts) > 1 else 0.0
+    print(f"rtt min/avg/max/stddev = {min(rtts):.3f}/{statistics.mean(rtts):.3f}/"
+          f"{max(rtts):.3f}/{statistics.pstdev(rtts):.3f} ms, jitter {jitter:.3f} ms")
+    printHistogram(rtts, bins)
+    print()
+
+
+# Helper function to draw the RTTs as equal-width buckets with # bars
+def printHistogram(rtts, bins):
+    low, high = min(rtts), max(rtts)
+    width = (high - low) / bins or 1.0
+    counts = [0] * bins
+    for rtt in rtts:
+        counts[min(bins - 1, int((rtt - low) / width))] += 1
+    scale = 40 / max(counts)
+    for i, n in enumerate(counts):
+        start = low + i * width
+        print(f"  {start:9.3f} - {start + width:9.3f} ms | {'#' * math.ceil(n * scale):<40} {n}")
+
+
 if __name__ == "__main__":
     main()
@@ -1,15 +1,188 @@
+"""
+Author: Everett Guyea
+Date: 18-10-2026
+
+UDP echo server for UDPPingerClient that also emulates a bad network. Every
+datagram is answered upper-cased, unless it is lost (at random, or in bursts
+with the Gilbert-Elliott model), held back by the rate limit, delayed with
+jitter, sent twice or delayed extra so that later replies overtake it. With
+no options it behaves like the original: port 12000 and about 4 in 11 pings
+dropped. --seed makes runs repeatable; --workers spreads the load over
+several processes sharing the port (SO_REUSEPORT).
+"""
+
+import argparse
+import heapq
+import itertools
+import multiprocessing
 import random
+import select
+import signal
+import time
 from socket import *
 
-serverSocket = socket(AF_INET, SOCK_DGRAM)
-serverSocket.bind(('', 12000))
-print("The server is ready to receive")
 
-while True:
-    rand = random.randint(0, 10)
-    message, address = serverSocket.recvfrom(1024)
-    message = message.upper()
-    if rand < 4:
-        continue
+def main():
+    parser = argparse.ArgumentParser(description="UDP ping server with network impairments")
+    parser.add_argument("--port", type=int, default=12000, help="port to listen on (default 12000)")
+    parser.add_argument("--loss", type=float, default=4 / 11,
+                        help="chance each ping is dropped (default 4/11, as randint(0, 10) < 4 gave)")
+    parser.add_argument("--gilbert", type=float, nargs=2, metavar=("P", "R"),
+                        help="bursty loss instead of --loss: P is the chance of going from the good "
+                             "state to the bad one, R of going back; bursts average 1/R pings")
+    parser.add_argument("--bad-loss", type=float, default=1.0, help="loss in the bad state (default 1)")
+    parser.add_argument("--good-loss", type=float, default=0.0, help="loss in the good state (default 0)")
+    parser.add_argument("--delay", type=float, default=0.0, help="milliseconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more milliseconds, at random")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="chance a reply is sent twice")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help="chance a reply is held back --reorder-delay ms so later ones overtake it")
+    parser.add_argument("--reorder-delay", type=float, default=10.0, help="milliseconds (default 10)")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="most pings per second answered; the rest are dropped (default no limit)")
+    parser.add_argument("--burst", type=int, default=0,
+                        help="pings the rate limit lets through at once (default one second's worth)")
+    parser.add_argument("--workers", type=int, default=1, help="processes sharing the port (default 1)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, so runs can be repeated")
+    args = parser.parse_args()
+
+    if args.workers > 1 and "SO_REUSEPORT" not in globals():
+        print("SO_REUSEPORT is not available here; using one worker")
+        args.workers = 1
+
+    print("The server is ready to receive")
+    if args.workers == 1:
+        runWorker(0, args)
+        return
+
+    workers = [multiprocessing.Process(target=runWorker, args=(i, args)) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; wait for their reports
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for worker in workers:
+            worker.join()
+
+
+class Impairment:
+    # decides the fate of each ping for one worker
+    def __init__(self, args, rng, workers):
+        self.args = args
+        self.rng = rng
+        self.bad = False
+        # the rate limit is shared out between the workers
+        self.rate = args.rate / workers
+        self.capacity = (args.burst or args.rate) / workers
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+
+    def policed(self, now):
+        # token bucket: each answered ping costs one token
+        if not self.rate:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def lost(self):
+        if self.args.gilbert is None:
+            return self.rng.random() < self.args.loss
+        p, r = self.args.gilbert
+        if self.bad:
+            self.bad = self.rng.random() >= r
+        else:
+            self.bad = self.rng.random() < p
+        return self.rng.random() < (self.args.bad_loss if self.bad else self.args.good_loss)
+
+    def delays(self):
+        # seconds until each copy of the reply goes out
+        copies = 2 if self.rng.random() < self.args.duplicate else 1
+        delays = []
+        for _ in range(copies):
+            delay = self.args.delay + self.rng.uniform(0, self.args.jitter)
+            reordered = self.rng.random() < self.args.reorder
+            if reordered:
+                delay += self.args.reorder_delay
+            delays.append((delay / 1000, reordered))
+        return delays
+
+
+def runWorker(index, args):
+    serverSocket = socket(AF_INET, SOCK_DGRAM)
+    if args.workers > 1:
+        # the kernel spreads senders over the workers' sockets
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    serverSocket.bind(('', args.port))
+    serverSocket.setblocking(False)
+
+    rng = random.Random(None if args.seed is None else args.seed + index)
+    impairment = Impairment(args, rng, args.workers)
+    waiting = []    # (send at, tiebreak, reply, address)
+    order = itertools.count()
+    stats = dict.fromkeys(("received", "sent", "lost", "policed", "duplicated", "reordered"), 0)
+
+    try:
+        while True:
+            now = time.monotonic()
+            while waiting and waiting[0][0] <= now:
+                _, _, reply, address = heapq.heappop(waiting)
+                sendReply(serverSocket, reply, address, stats)
+
+            timeout = min(0.5, waiting[0][0] - now) if waiting else 0.5
+            readable, _, _ = select.select([serverSocket], [], [], max(timeout, 0))
+            if not readable:
+                continue
+
+            # answer every ping already waiting, not just one per wakeup
+            now = time.monotonic()
+            while True:
+                try:
+                    message, address = serverSocket.recvfrom(65535)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionResetError:
+                    continue
+                stats["received"] += 1
+                if impairment.policed(now):
+                    stats["policed"] += 1
+                    continue
+                if impairment.lost():
+                    stats["lost"] += 1
+                    continue
+
+                message = message.upper()
+                delays = impairment.delays()
+                stats["duplicated"] += len(delays) - 1
+                for delay, reordered in delays:
+                    stats["reordered"] += reordered
+                    if delay <= 0:
+                        sendReply(serverSocket, message, address, stats)
+                    else:
+                        heapq.heappush(waiting, (now + delay, next(order), message, address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        serverSocket.close()
+        print(f"worker {index}: " + ", ".join(f"{name} {count}" for name, count in stats.items()))
+
+
+# Helper function to send one reply, counting it
+def sendReply(serverSocket, reply, address, stats):
+    try:
+        serverSocket.sendto(reply, address)
+        stats["sent"] += 1
+    except BlockingIOError:
+        pass    # the send buffer is full; the ping is lost like on a real network
+    except OSError:
+        pass
+
 
-    serverSocket.sendto(message, address)
+if __name__ == "__main__":
+    main()
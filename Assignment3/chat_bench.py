@@ -0,0 +1,308 @@
+"""
+Author: Everett Guyea
+Date: 18-10-2026
+
+Load generator and benchmark for the chatroom servers. Starts ServerTCP or
+ServerUDP in its own process, connects N ClientTCP/ClientUDP clients spread
+over worker processes (or threads with --processes 0), and has every client
+send timestamped messages at a fixed rate to the shared channel. For each
+client count it reports messages per second, the end-to-end fan-out latency
+from sender to each receiver, the server's CPU and memory, and how many
+deliveries were lost, and it saves everything as JSON so runs can be
+compared over time.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from chatroom import ClientTCP, ClientUDP
+
+# latencies each worker keeps, sampled evenly from all it measured
+SAMPLES_PER_WORKER = 50000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chatroom servers under load")
+    parser.add_argument("--protocol", choices=("tcp", "udp", "both"), default="both",
+                        help="which server to benchmark (default both)")
+    parser.add_argument("--clients", default="10,50,100",
+                        help="comma-separated client counts to step through (default 10,50,100)")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second per client (default 5)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending per step (default 10)")
+    parser.add_argument("--size", type=int, default=64, help="bytes of padding per message (default 64)")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="client worker processes; 0 runs the clients in threads of this process")
+    parser.add_argument("--reliable", action="store_true", help="UDP clients use ReliableUDP")
+    parser.add_argument("--flush-window", type=float, default=None,
+                        help="ServerUDP flush_window; unset sends every line at once")
+    parser.add_argument("--port", type=int, default=12600, help="first server port to use (default 12600)")
+    parser.add_argument("--output", default=None,
+                        help="JSON results file (default chat_bench-<time>.json)")
+    args = parser.parse_args()
+
+    protocols = ("tcp", "udp") if args.protocol == "both" else (args.protocol,)
+    counts = [int(value) for value in args.clients.split(",")]
+    output = args.output or f"chat_bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+
+    print(f"{args.rate:g} msg/s per client for {args.duration:g} s, {args.size} byte padding, "
+          f"{args.processes or 'in-process'} client workers\n")
+    print(f"{'proto':<7}{'clients':>8}{'sent/s':>9}{'recv/s':>10}{'drop %':>8}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'CPU %':>7}{'RSS MiB':>9}")
+    results = []
+    port = args.port
+    for protocol in protocols:
+        for count in counts:
+            result = run_step(protocol, count, args, port)
+            port += 1
+            results.append(result)
+            print(f"{protocol:<7}{count:>8}{result['sent_per_sec']:>9.0f}{result['delivered_per_sec']:>10.0f}"
+                  f"{result['drop_pct']:>8.2f}{result['latency_ms']['p50']:>9.1f}{result['latency_ms']['p95']:>9.1f}"
+                  f"{result['latency_ms']['p99']:>9.1f}{result['server']['cpu_pct']:>7.0f}"
+                  f"{result['server']['peak_rss_mib']:>9.1f}")
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "results": results,
+    }
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"\nSaved {output}")
+
+
+def run_step(protocol, count, args, port):
+    server = start_server(protocol, port, args)
+    workers = max(1, args.processes)
+    names = [[f"bench{i}" for i in range(w, count, workers)] for w in range(workers)]
+    names = [group for group in names if group]
+    if args.processes:
+        context = multiprocessing.get_context("spawn" if sys.platform == "win32" else "fork")
+        ready, go, results = context.Queue(), context.Event(), context.Queue()
+        runners = [context.Process(target=run_clients, args=(protocol, port, group, args, ready, go, results))
+                   for group in names]
+    else:
+        ready, go, results = queue.Queue(), threading.Event(), queue.Queue()
+        runners = [threading.Thread(target=run_clients, args=(protocol, port, group, args, ready, go, results))
+                   for group in names]
+    try:
+        for runner in runners:
+            runner.start()
+        joined = sum(ready.get(timeout=60) for _ in runners)
+
+        cpu_start = server_cpu(server.pid)
+        start = time.monotonic()
+        go.set()
+        reports = [results.get(timeout=args.duration + 60) for _ in runners]
+        # the time includes the wait for stragglers, when the server is idle
+        elapsed = time.monotonic() - start
+        cpu = server_cpu(server.pid) - cpu_start
+        rss = server_memory(server.pid)
+    finally:
+        for runner in runners:
+            runner.join(5)
+        server_stats = stop_server(server)
+
+    sent = sum(report["sent"] for report in reports)
+    delivered = sum(report["delivered"] for report in reports)
+    # everyone is in the default channel, so each message is owed to every other client
+    expected = sum(report["sent"] for report in reports) * (joined - 1)
+    latencies = sorted(latency for report in reports for latency in report["latencies"])
+    return {
+        "protocol": protocol,
+        "clients": count,
+        "joined": joined,
+        "sent": sent,
+        "delivered": delivered,
+        "expected": expected,
+        "sent_per_sec": sent / args.duration,
+        "delivered_per_sec": delivered / args.duration,
+        "drop_pct": 100.0 * (1 - delivered / expected) if expected else 0.0,
+        "latency_ms": {f"p{p}": percentile(latencies, p) * 1000 for p in (50, 90, 95, 99, 100)},
+        "server": {
+            "cpu_seconds": cpu,
+            "cpu_pct": 100.0 * cpu / elapsed,
+            "rss_mib": rss["VmRSS"] / 1024,
+            "peak_rss_mib": rss["VmHWM"] / 1024,
+            "stats": server_stats,
+        },
+    }
+
+
+# Helper function to run clients in one worker: connect them all, report how
+# many joined, wait for go, then send for args.duration seconds while timing
+# every message that arrives
+def run_clients(protocol, port, names, args, ready, go, results):
+    clients = []
+    with contextlib.redirect_stdout(io.StringIO()):    # connect_server prints "Welcome"
+        for name in names:
+            if protocol == "tcp":
+                client = ClientTCP(name, port)
+            else:
+                client = ClientUDP(name, port, reliable=args.reliable, heartbeat_interval=None)
+            if client.connect_server():
+                clients.append(client)
+    ready.put(len(clients))
+
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.client_socket, selectors.EVENT_READ, client)
+    rng = random.Random()
+    padding = "x" * args.size
+    interval = 1 / args.rate
+    sent = delivered = seen = 0
+    latencies = []
+
+    def take(client):
+        # time the chat lines the client has queued
+        nonlocal delivered, seen
+        now = time.time()
+        while client.pending:
+            line = client.pending.popleft()
+            if isinstance(line, bytes):
+                line = line.decode()
+            _, _, text = line.partition(": ")
+            if not text.startswith("t="):
+                continue
+            delivered += 1
+            seen += 1
+            latency = now - float(text[2:text.index(" ")])
+            # reservoir sampling keeps an even sample of every latency seen
+            if len(latencies) < SAMPLES_PER_WORKER:
+                latencies.append(latency)
+            else:
+                slot = rng.randrange(seen)
+                if slot < SAMPLES_PER_WORKER:
+                    latencies[slot] = latency
+
+    def pump(wait):
+        for key, _ in selector.select(wait):
+            client = key.data
+            try:
+                if protocol == "tcp":
+                    messages = client.decoder.recv_from(client.client_socket, client.recv_view)
+                    if messages is None:
+                        selector.unregister(client.client_socket)
+                        continue
+                    client.pending.extend(messages)
+                else:
+                    client.read_datagrams(0)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                selector.unregister(client.client_socket)
+                continue
+            take(client)
+        if args.reliable and protocol == "udp":
+            for client in clients:
+                client.reliable.poll()
+
+    go.wait()
+    start = time.monotonic()
+    # spread the first sends over one interval so clients do not fire in step
+    next_send = [start + rng.random() * interval for _ in clients]
+    end = start + args.duration
+    n = 0
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        for i, client in enumerate(clients):
+            while next_send[i] <= now and next_send[i] < end:
+                client.send(f"t={time.time():.6f} n={n} {padding}")
+                next_send[i] += interval
+                sent += 1
+                n += 1
+        pump(max(0.0, min(min(next_send, default=end), end) - time.monotonic()))
+
+    # let what is still in flight arrive
+    quiet_until = time.monotonic() + 1.0
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < min(quiet_until, deadline):
+        before = delivered
+        pump(0.05)
+        if delivered != before:
+            quiet_until = time.monotonic() + 1.0
+
+    for client in clients:
+        try:
+            client.send("exit")
+            client.client_socket.close()
+        except OSError:
+            pass
+    selector.close()
+    results.put({"sent": sent, "delivered": delivered, "latencies": latencies})
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, -(-p * len(values) // 100) - 1)]
+
+
+# Helper function to run the server in its own process; it prints its
+# counters as JSON once stopped
+def start_server(protocol, port, args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    if protocol == "tcp":
+        code = (f"import chatroom, json; server = chatroom.ServerTCP({port}); server.run(); "
+                f"print(json.dumps(server.get_queue_stats()))")
+    else:
+        code = (f"import chatroom, json; server = chatroom.ServerUDP({port}, flush_window={args.flush_window!r}); "
+                f"server.run(); print(json.dumps(dict(server.get_io_stats(), reliable=server.reliable.stats())))")
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=here,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    time.sleep(0.5)
+    return server
+
+
+def stop_server(server):
+    # Ctrl+C lets the server shut down cleanly and print its counters
+    server.send_signal(signal.SIGINT)
+    try:
+        output, _ = server.communicate(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+        return {}
+    lines = output.strip().splitlines()
+    try:
+        return json.loads(lines[-1]) if lines else {}
+    except ValueError:
+        return {}
+
+
+# Helper function to read a process's user plus system CPU time, in seconds
+def server_cpu(pid):
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+# Helper function to read current and peak resident memory, in KiB
+def server_memory(pid):
+    memory = {"VmRSS": 0, "VmHWM": 0}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key = line.split(":", 1)[0]
+            if key in memory:
+                memory[key] = int(line.split()[1])
+    return memory
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,338 @@
+import heapq
+import json
+import os
+import random
 import select
+import selectors
+import struct
+import time
+from collections import OrderedDict, deque
+from itertools import islice, takewhile
 from socket import *
 import threading
 
 
+# every TCP message is a 4-byte big-endian length followed by that many bytes of UTF-8
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME = 64 * 1024
+
+
+def encode_frame(text):
+    data = text.encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def encode_frames(texts):
+    # several messages in one buffer, so they go out in one send
+    return b"".join(encode_frame(text) for text in texts)
+
+
+class FrameDecoder:
+    # turns the bytes of a TCP stream back into whole messages, however
+    # they were split or merged on the way; keeps only an unfinished frame
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data):
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        messages = []
+        pos = 0
+        end = len(data)
+        while end - pos >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(data, pos)
+            if length > self.max_frame:
+                raise ValueError(f"frame of {length} bytes is over the {self.max_frame} byte limit")
+            start = pos + FRAME_HEADER.size
+            if end - start < length:
+                break
+            messages.append(str(data[start:start + length], "utf-8", "replace"))
+            pos = start + length
+        if data is self.buffer:
+            del self.buffer[:pos]
+        else:
+            self.buffer += data[pos:]
+        return messages
+
+    def recv_from(self, sock, view):
+        # read into the caller's reusable buffer; None once the peer has closed
+        n = sock.recv_into(view)
+        if not n:
+            return None
+        return self.feed(view[:n])
+
+
+class ClientRegistry:
+    # who is connected, indexed both ways: socket -> name and name -> socket.
+    # Changes happen under a lock; broadcasts iterate snapshot(), an immutable
+    # tuple that is only rebuilt after the membership has changed
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = {}
+        self.sockets = {}
+        self.cached = ()
+
+    def add(self, client_socket, client_name):
+        # False if the name (or the socket) is already registered
+        with self.lock:
+            if client_name in self.sockets or client_socket in self.names:
+                return False
+            self.names[client_socket] = client_name
+            self.sockets[client_name] = client_socket
+            self.cached = None
+            return True
+
+    def remove(self, client_socket):
+        # the removed client's name, or None if it was not registered
+        with self.lock:
+            client_name = self.names.pop(client_socket, None)
+            if client_name is not None:
+                del self.sockets[client_name]
+                self.cached = None
+            return client_name
+
+    def snapshot(self):
+        snapshot = self.cached
+        if snapshot is None:
+            with self.lock:
+                if self.cached is None:
+                    self.cached = tuple(self.names.items())
+                snapshot = self.cached
+        return snapshot
+
+    def get(self, client_socket, default=None):
+        return self.names.get(client_socket, default)
+
+    def socket_for(self, client_name):
+        return self.sockets.get(client_name)
+
+    def __getitem__(self, client_socket):
+        return self.names[client_socket]
+
+    def __contains__(self, client_socket):
+        return client_socket in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return [client_socket for client_socket, _ in self.snapshot()]
+
+    def values(self):
+        return [client_name for _, client_name in self.snapshot()]
+
+    def items(self):
+        return self.snapshot()
+
+
+# everyone starts in this channel; its messages carry no channel tag
+DEFAULT_CHANNEL = "general"
+
+
+def channel_prefix(channel):
+    return "" if channel == DEFAULT_CHANNEL else f"[#{channel}] "
+
+
+def parse_channel_command(text):
+    # "/join name", "/leave [name]" or "/part [name]" -> (command, channel);
+    # None for anything else. A missing channel name comes back as None
+    parts = text.split()
+    if not parts or parts[0] not in ("/join", "/leave", "/part") or len(parts) > 2:
+        return None
+    command = "join" if parts[0] == "/join" else "leave"
+    channel = parts[1].lstrip("#") if len(parts) == 2 else None
+    return command, channel or None
+
+
+class ChannelDirectory:
+    # named channels, each a ClientRegistry of its members, so routing a
+    # message only touches that channel. A client can be in several; what it
+    # says goes to the one it joined (or re-joined) most recently
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.joined = {}    # client -> its channel names, current one last
+
+    def join(self, client, client_name, channel):
+        # False if the client was already a member (it still becomes current)
+        with self.lock:
+            joined = self.joined.setdefault(client, [])
+            if channel in joined:
+                joined.remove(channel)
+                joined.append(channel)
+                return False
+            members = self.channels.get(channel)
+            if members is None:
+                members = self.channels[channel] = ClientRegistry()
+            members.add(client, client_name)
+            joined.append(channel)
+            return True
+
+    def leave(self, client, channel):
+        with self.lock:
+            joined = self.joined.get(client)
+            if not joined or channel not in joined:
+                return False
+            joined.remove(channel)
+            if not joined:
+                del self.joined[client]
+            members = self.channels[channel]
+            members.remove(client)
+            if not len(members):
+                del self.channels[channel]
+            return True
+
+    def leave_all(self, client):
+        # the channels the client was in
+        with self.lock:
+            channels = list(self.joined.get(client, ()))
+        for channel in channels:
+            self.leave(client, channel)
+        return channels
+
+    def current(self, client):
+        joined = self.joined.get(client)
+        return joined[-1] if joined else None
+
+    def members(self, channel):
+        members = self.channels.get(channel)
+        return members.snapshot() if members is not None else ()
+
+    def size(self, channel):
+        members = self.channels.get(channel)
+        return len(members) if members is not None else 0
+
+
+class MessageHistory:
+    # the last `capacity` messages of each channel, in rings that never grow,
+    # for replaying to whoever joins. With log_path every message is also
+    # appended to a file (one JSON [channel, text] per line) that is read back
+    # on start; once compact_every lines have been appended since the last
+    # rewrite, the file is rewritten to hold only what the rings still have.
+    # Only the most recent max_channels channels keep a history
+    def __init__(self, capacity=100, log_path=None, compact_every=1000, max_channels=64):
+        self.capacity = capacity
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.max_channels = max_channels
+        self.lock = threading.Lock()
+        self.rings = OrderedDict()    # channel -> deque of texts, least recently used first
+        self.log = None
+        self.appended = 0
+        if log_path is not None:
+            self.load()
+            self.compact()
+
+    def add(self, channel, text):
+        with self.lock:
+            self.remember(channel, text)
+            if self.log is None:
+                return
+            self.log.write(json.dumps([channel, text]) + "\n")
+            self.appended += 1
+            if self.appended >= self.compact_every:
+                self.compact_locked()
+
+    def recent(self, channel, count=None):
+        # oldest first
+        with self.lock:
+            ring = self.rings.get(channel)
+            if ring is None:
+                return []
+            if count is None or count >= len(ring):
+                return list(ring)
+            return list(islice(ring, len(ring) - count, None))
+
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    # the rest expect the lock to be held
+
+    def remember(self, channel, text):
+        ring = self.rings.get(channel)
+        if ring is None:
+            ring = self.rings[channel] = deque(maxlen=self.capacity)
+            if len(self.rings) > self.max_channels:
+                self.rings.popitem(last=False)
+        else:
+            self.rings.move_to_end(channel)
+        ring.append(text)
+
+    def load(self):
+        try:
+            log_file = open(self.log_path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        with log_file:
+            for line in log_file:
+                try:
+                    channel, text = json.loads(line)
+                except ValueError:
+                    continue    # e.g. a line cut short by a crash
+                self.remember(channel, text)
+
+    def compact_locked(self):
+        if self.log_path is None:
+            return
+        if self.log is not None:
+            self.log.close()
+        # write the new file beside the old one and swap, so a crash part way
+        # through leaves one of them whole
+        tmp_path = self.log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for channel, ring in self.rings.items():
+                for text in ring:
+                    tmp.write(json.dumps([channel, text]) + "\n")
+        os.replace(tmp_path, self.log_path)
+        # line buffered: each message reaches the file as it is added
+        self.log = open(self.log_path, "a", encoding="utf-8", buffering=1)
+        self.appended = 0
+
+
+class OutboundQueue:
+    # messages waiting to be written to one client, oldest first
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0    # bytes still to send
+        self.sent = 0    # bytes of chunks[0] already sent
+
+
 class ServerTCP:
-    def __init__(self, server_port):
+    # slow_policy is what happens once a client has more than max_queue_bytes
+    # waiting: "drop" discards its oldest queued messages, "disconnect" closes it.
+    # Each channel keeps its last history_size messages (see MessageHistory)
+    # and whoever joins it gets the last `replay` of them
+    def __init__(self, server_port, max_queue_bytes=256 * 1024, slow_policy="drop",
+                 history_size=100, history_log=None, replay=20):
+        if slow_policy not in ("drop", "disconnect"):
+            raise ValueError(f"unknown slow_policy: {slow_policy}")
         self.server_port = server_port
         self.server_socket = socket(AF_INET, SOCK_STREAM)
         addr = gethostbyname(gethostname())
         self.server_socket.bind((addr, server_port))
-        self.server_socket.listen()
-        self.clients = {}
+        self.server_socket.listen(SOMAXCONN)
+        self.clients = ClientRegistry()
+        self.channels = ChannelDirectory()
+        # run() watches the listening socket and every client socket here
+        self.selector = selectors.DefaultSelector()
+        self.outbound = {}
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_policy = slow_policy
+        self.queue_counters = {"queued": 0, "dropped": 0, "slow_disconnects": 0, "peak_queue_bytes": 0}
+        self.history = MessageHistory(history_size, history_log)
+        self.replay = replay
+        # one receive buffer serves every client, since one thread reads them all
+        self.decoders = {}
+        self.recv_view = memoryview(bytearray(65536))
         self.run_event = threading.Event()
         self.handle_event = threading.Event()
         self.run_event.clear()
@@ -26,48 +348,69 @@ class ServerTCP:
             client_socket, client_addr = self.server_socket.accept()
 
             # get client name
-            name_bytes = client_socket.recv(1024)
-            if not name_bytes:
-                client_socket.close()
-                return False
+            decoder = self.decoders[client_socket] = FrameDecoder()
+            messages = []
+            while not messages:
+                messages = decoder.recv_from(client_socket, self.recv_view)
+                if messages is None:
+                    self.close_client(client_socket)
+                    return False
+            return self.add_client(client_socket, messages[0])
 
-            client_name = name_bytes.decode().strip()
+        except Exception:
+            return False
 
-            # check if name is used
-            if client_name in self.clients.values():
+    def add_client(self, client_socket, client_name):
+        try:
+            client_name = client_name.strip()
+
+            # claim the name; fails if it is used
+            if not self.clients.add(client_socket, client_name):
                 try:
-                    client_socket.sendall(b"Name already taken")
+                    client_socket.sendall(encode_frame("Name already taken"))
                 finally:
-                    client_socket.close()
+                    self.close_client(client_socket)
                 return False
 
-            # name unique: welcome client
-            client_socket.sendall(b"Welcome")
-            self.clients[client_socket] = client_name
+            # name unique: welcome client, with what was said lately in one
+            # write; whatever the socket does not take now waits in its queue
+            self.queue_send(client_socket, encode_frames(["Welcome"] + self.recent_history(DEFAULT_CHANNEL)))
+            if client_socket not in self.clients:
+                return False
             # announce user joining
+            self.channels.join(client_socket, client_name, DEFAULT_CHANNEL)
             self.broadcast(client_socket, "join")
 
             return True
 
         except Exception:
+            if client_socket not in self.clients:
+                self.close_client(client_socket)
             return False
 
     def close_client(self, client_socket):
         try:
-            if client_socket not in self.clients:
+            # stop watching the socket before it is closed
+            try:
+                self.selector.unregister(client_socket)
+            except (KeyError, ValueError):
+                pass
+            self.decoders.pop(client_socket, None)
+            # on_name queues for the socket before the name is claimed
+            self.outbound.pop(client_socket, None)
+
+            # only the caller that removes the client announces it
+            client_name = self.clients.remove(client_socket)
+            if client_name is None:
                 try:
                     client_socket.close()
                 except:
                     pass
                 return False
 
-            # find client name
-            client_name = self.clients[client_socket]
-
-            if client_name:    # announce they left
-                self.broadcast(client_socket, "exit")
-
-            del self.clients[client_socket]
+            for channel in self.channels.leave_all(client_socket):
+                if client_name:    # announce they left
+                    self.fan_out(client_socket, encode_frame(f"{channel_prefix(channel)}User {client_name} left"), channel)
 
             try:    # close their socket
                 client_socket.close()
@@ -80,41 +423,167 @@ class ServerTCP:
             return False
 
     def broadcast(self, client_socket_sent, message):
+        self.broadcast_many(client_socket_sent, [message])
+
+    def broadcast_many(self, client_socket_sent, messages):
         try:
             sender_name = self.clients.get(client_socket_sent)
 
-            if sender_name is None:
+            if sender_name is None or not messages:
                 return
 
-            # format message
-            if message == "join":
-                f_msg = f"User {sender_name} joined"
-            elif message == "exit":
-                f_msg = f"User {sender_name} left"
+            # messages go to the sender's current channel
+            channel = self.channels.current(client_socket_sent)
+            if channel is None:
+                self.queue_send(client_socket_sent, encode_frame("You are not in a channel; /join one to talk"))
+                return
+            prefix = channel_prefix(channel)
+
+            # format messages; only what people said goes into the history
+            f_msgs = []
+            for message in messages:
+                if message == "join":
+                    f_msgs.append(f"{prefix}User {sender_name} joined")
+                elif message == "exit":
+                    f_msgs.append(f"{prefix}User {sender_name} left")
+                else:
+                    f_msgs.append(f"{prefix}{sender_name}: {message}")
+                    self.history.add(channel, f_msgs[-1])
+
+            # one buffer per batch, so each client gets it in one send
+            self.fan_out(client_socket_sent, encode_frames(f_msgs), channel)
+
+        except Exception:
+            pass
+
+    def fan_out(self, client_socket_sent, data, channel):
+        # queue for the channel's members; nobody waits on a slow reader
+        for sock, name in self.channels.members(channel):
+            if sock is client_socket_sent:
+                continue
+            self.queue_send(sock, data)
+
+    def handle_command(self, client_socket, command, channel):
+        client_name = self.clients.get(client_socket)
+        replay = []
+        if command == "join":
+            if channel is None:
+                self.queue_send(client_socket, encode_frame("Usage: /join <channel>"))
+                return
+            if self.channels.join(client_socket, client_name, channel):
+                self.fan_out(client_socket, encode_frame(f"{channel_prefix(channel)}User {client_name} joined"), channel)
+                # a newcomer catches up on the channel with the reply
+                replay = self.recent_history(channel)
+            size = self.channels.size(channel)
+            reply = f"Now talking in #{channel} ({size} member{'' if size == 1 else 's'})"
+        else:
+            channel = channel or self.channels.current(client_socket)
+            if channel is not None and self.channels.leave(client_socket, channel):
+                self.fan_out(client_socket, encode_frame(f"{channel_prefix(channel)}User {client_name} left"), channel)
+                current = self.channels.current(client_socket)
+                reply = f"Left #{channel}; now talking in #{current}" if current else f"Left #{channel}"
             else:
-                f_msg = f"{sender_name}: {message}"
+                reply = f"You are not in #{channel}" if channel else "You are not in a channel"
+        self.queue_send(client_socket, encode_frames([reply] + replay))
 
-            encoded = f_msg.encode()
+    def recent_history(self, channel):
+        return self.history.recent(channel, self.replay) if self.replay else []
 
-            # send to clients
-            for sock, name in list(self.clients.items()):
-                if sock is client_socket_sent:
-                    continue
+    def queue_send(self, client_socket, data):
+        queue = self.outbound.get(client_socket)
+        queued = len(data)
+        try:
+            if queue is None:
+                # blocking client outside the event loop (handle_client)
+                client_socket.sendall(data)
+                return
+            if not queue.chunks:
+                # nothing waiting: try to send straight away
                 try:
-                    sock.sendall(encoded)
-                except:
-                    self.close_client(sock)
+                    sent = client_socket.send(data)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                if sent == len(data):
+                    return
+                queue.sent = sent
+                queued -= sent
+                self.watch_writable(client_socket, True)
+        except OSError:
+            self.close_client(client_socket)
+            return
 
-        except Exception:
+        queue.chunks.append(data)
+        queue.size += queued
+        self.queue_counters["queued"] += 1
+        if queue.size > self.queue_counters["peak_queue_bytes"]:
+            self.queue_counters["peak_queue_bytes"] = queue.size
+
+        if queue.size <= self.max_queue_bytes:
+            return
+        if self.slow_policy == "disconnect":
+            self.queue_counters["slow_disconnects"] += 1
+            self.close_client(client_socket)
+            return
+        # drop whole messages, never the one already partly on the wire
+        while queue.size > self.max_queue_bytes and len(queue.chunks) > 1:
+            if queue.sent == 0:
+                dropped = queue.chunks.popleft()
+            else:
+                dropped = queue.chunks[1]
+                del queue.chunks[1]
+            queue.size -= len(dropped)
+            self.queue_counters["dropped"] += 1
+
+    def flush(self, client_socket):
+        # write as much of the queue as the socket takes without blocking
+        queue = self.outbound.get(client_socket)
+        if queue is None:
+            return
+        try:
+            while queue.chunks:
+                # hand the kernel up to 64 queued messages per call
+                buffers = [memoryview(queue.chunks[0])[queue.sent:]]
+                buffers.extend(islice(queue.chunks, 1, 64))
+                sent = client_socket.sendmsg(buffers)
+                queue.size -= sent
+                sent += queue.sent
+                while queue.chunks and sent >= len(queue.chunks[0]):
+                    sent -= len(queue.chunks.popleft())
+                queue.sent = sent
+                if sent:
+                    return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_client(client_socket)
+            return
+        self.watch_writable(client_socket, False)
+
+    def watch_writable(self, client_socket, writable):
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if writable else selectors.EVENT_READ
+        try:
+            self.selector.modify(client_socket, events, self.on_client)
+        except (KeyError, ValueError):
             pass
 
+    def get_queue_stats(self):
+        # current queue depth across clients plus the slow-consumer counters
+        stats = dict(self.queue_counters)
+        stats["queued_bytes"] = sum(queue.size for queue in self.outbound.values())
+        stats["queued_messages"] = sum(len(queue.chunks) for queue in self.outbound.values())
+        stats["backlogged_clients"] = sum(1 for queue in self.outbound.values() if queue.chunks)
+        return stats
+
     def shutdown(self):
         try:
             # send server shutdown message to clients
-            msg = b"server-shutdown"
-            for sock in list(self.clients.keys()):
+            for sock, name in self.clients.snapshot():
                 try:
-                    sock.sendall(msg)
+                    # give each client a moment to take what is still queued
+                    queue = self.outbound.get(sock)
+                    pending = b"".join(queue.chunks)[queue.sent:] if queue else b""
+                    sock.settimeout(0.5)
+                    sock.sendall(pending + encode_frame("server-shutdown"))
                 except:
                     pass
                 self.close_client(sock)
@@ -129,6 +598,7 @@ class ServerTCP:
                 self.server_socket.close()
             except:
                 pass
+            self.history.close()
 
         except Exception:
             pass
@@ -137,32 +607,100 @@ class ServerTCP:
         return len(self.clients)
 
     def handle_client(self, client_socket):
+        # this thread needs its own receive buffer
+        view = memoryview(bytearray(65536))
         while not self.handle_event.is_set():
             try:
                 readability, _, _ = select.select([client_socket], [], [], 0.5)
-                if not readability:
-                    continue
-
-                data = client_socket.recv(1024)
+            except Exception:
+                self.close_client(client_socket)
+                break
+            if readability and not self.handle_message(client_socket, view):
+                break
 
-                if not data:
-                    self.close_client(client_socket)
-                    break
+    def handle_message(self, client_socket, view=None):
+        # read what a readable client sent; False once the client is gone
+        try:
+            decoder = self.decoders.setdefault(client_socket, FrameDecoder())
+            try:
+                messages = decoder.recv_from(client_socket, view or self.recv_view)
+            except (BlockingIOError, InterruptedError):
+                return True
 
-                message = data.decode().strip()
+            if messages is None:
+                self.close_client(client_socket)
+                return False
 
-                if message == "exit":
-                    self.close_client(client_socket)
-                    break
+            return self.relay(client_socket, messages)
 
-                self.broadcast(client_socket, message)
+        except (ConnectionResetError, ConnectionAbortedError):
+            self.close_client(client_socket)
+            return False
+        except Exception:
+            self.close_client(client_socket)
+            return False
 
-            except (ConnectionResetError, ConnectionAbortedError):
-                self.close_client(client_socket)
-                break
-            except Exception:
+    def relay(self, client_socket, messages):
+        # messages that arrived together go out together
+        batch = []
+        for message in messages:
+            message = message.strip()
+            if message == "exit":
+                self.broadcast_many(client_socket, batch)
                 self.close_client(client_socket)
-                break
+                return False
+            command = parse_channel_command(message)
+            if command is not None:
+                # send what came before the command to the old channel
+                self.broadcast_many(client_socket, batch)
+                batch = []
+                self.handle_command(client_socket, *command)
+                continue
+            batch.append(message)
+        self.broadcast_many(client_socket, batch)
+        return True
+
+    def on_accept(self, server_socket, mask):
+        # take every connection waiting in the backlog
+        while True:
+            try:
+                client_socket, client_addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:    # e.g. out of file descriptors
+                return
+            client_socket.setblocking(False)
+            # the name arrives later; wait for it without holding up the loop
+            self.decoders[client_socket] = FrameDecoder()
+            self.selector.register(client_socket, selectors.EVENT_READ, self.on_name)
+
+    def on_name(self, client_socket, mask):
+        try:
+            messages = self.decoders[client_socket].recv_from(client_socket, self.recv_view)
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception:
+            self.close_client(client_socket)
+            return
+        if messages is None:
+            self.close_client(client_socket)
+            return
+        if not messages:    # only part of the name so far
+            return
+
+        # the queue comes first so the welcome and replay can wait in it
+        self.outbound[client_socket] = OutboundQueue()
+        self.selector.modify(client_socket, selectors.EVENT_READ, self.on_client)
+        if self.add_client(client_socket, messages[0]):
+            # the client may have sent messages right behind its name
+            if len(messages) > 1:
+                self.relay(client_socket, messages[1:])
+
+    def on_client(self, client_socket, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush(client_socket)
+        if mask & selectors.EVENT_READ and client_socket in self.clients:
+            self.handle_message(client_socket)
 
     def run(self):
         if hasattr(self, "run_event"):
@@ -172,23 +710,15 @@ class ServerTCP:
 
         print("Server started. Press Ctrl+C to stop.")
 
+        # one thread serves everyone: the selector reports which sockets are
+        # ready and each gets its callback (on_accept, on_name or on_client)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, self.on_accept)
+
         try:
             while not self.run_event.is_set():
-                before = set(self.clients.keys())
-
-                accepted = self.accept_client()
-
-                if accepted:
-                    after = set(self.clients.keys())
-                    new_socket = after - before
-
-                    for client_socket in new_socket:
-                        t = threading.Thread(
-                            target=self.handle_client,
-                            args=(client_socket,),
-                            daemon=True
-                        )
-                        t.start()
+                for key, mask in self.selector.select(0.5):
+                    key.data(key.fileobj, mask)
         except KeyboardInterrupt:
             print("\nKeyboardInterrupt: shutting down server...")
         finally:
@@ -198,6 +728,7 @@ class ServerTCP:
                 self.handle_event.set()
 
             self.shutdown()
+            self.selector.close()
 
 
 class ClientTCP:
@@ -208,19 +739,26 @@ class ClientTCP:
         self.client_name = client_name
         self.exit_run = threading.Event()
         self.exit_receive = threading.Event()
+        self.decoder = FrameDecoder()
+        self.recv_view = memoryview(bytearray(65536))
+        self.pending = deque()
 
     def connect_server(self):
         try:
             self.client_socket.connect((self.server_addr, self.server_port))
             # send name to server
-            self.client_socket.sendall(self.client_name.encode())
+            self.client_socket.sendall(encode_frame(self.client_name))
             # wait for reply from server
-            response = self.client_socket.recv(1024)
-            if not response:
-                print("No response from server.")
-                return False
+            messages = []
+            while not messages:
+                messages = self.decoder.recv_from(self.client_socket, self.recv_view)
+                if messages is None:
+                    print("No response from server.")
+                    return False
+            # anything after the reply is chat for receive()
+            self.pending.extend(messages[1:])
 
-            msg = response.decode().strip()
+            msg = messages[0].strip()
 
             if "Welcome" in msg:
                 print(msg)
@@ -234,8 +772,12 @@ class ClientTCP:
             return False
 
     def send(self, text):
+        self.send_many([text])
+
+    def send_many(self, texts):
+        # several messages in one write; the server keeps them apart
         try:
-            self.client_socket.sendall(text.encode())
+            self.client_socket.sendall(encode_frames(texts))
         except Exception as e:
             print(f"Send error: {e}")
             self.exit_run.set()
@@ -244,17 +786,19 @@ class ClientTCP:
     def receive(self):
         while not self.exit_receive.is_set():
             try:
-                readability, _, _ = select.select([self.client_socket], [], [], 0.5)
-                if not readability:
-                    continue
+                if not self.pending:
+                    readability, _, _ = select.select([self.client_socket], [], [], 0.5)
+                    if not readability:
+                        continue
 
-                data = self.client_socket.recv(1024)
-                if not data:
-                    print("Server closed the connection")
-                    self.exit_run.set()
-                    break
+                    messages = self.decoder.recv_from(self.client_socket, self.recv_view)
+                    if messages is None:
+                        print("Server closed the connection")
+                        self.exit_run.set()
+                        break
+                    self.pending.extend(messages)
 
-                msg = data.decode().strip()
+                msg = self.pending.popleft().strip()
                 if msg == "server-shutdown":
                     print("Server is shutting down.")
                     self.exit_run.set()
@@ -310,33 +854,507 @@ class ClientTCP:
             self.exit_receive.set()
 
 
+# optional reliability for the UDP chat. Reliable datagrams start with
+# RELIABLE_MAGIC and a header; anything else is a plain chat datagram, so
+# plain and reliable clients can share a server
+RELIABLE_MAGIC = b"\x00R"
+DATA_PACKET, ACK_PACKET, NACK_PACKET = 1, 2, 3
+PACKET_HEADER = struct.Struct("!2sBII")    # magic, type, session, seq (DATA) or next expected seq
+SACK_RANGE = struct.Struct("!II")          # [start, end) received beyond the next expected seq
+NACK_SEQ = struct.Struct("!I")
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 4.0
+REORDER_THRESHOLD = 3    # a packet is reported missing once this many later ones arrived
+
+
+def is_reliable_packet(data):
+    return data[:2] == RELIABLE_MAGIC
+
+
+class ReliablePeer:
+    # both directions of the reliable stream with one address
+    def __init__(self):
+        # sending: session tells the receiver when we have restarted
+        self.session = random.getrandbits(32)
+        self.next_seq = 0
+        self.unacked = OrderedDict()    # seq -> [packet, last sent, times sent, timeouts in a row]
+        self.pending = deque()          # waiting for room in the window
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.closing = False
+        self.heard = time.monotonic()    # last packet of any kind from the peer
+        # receiving
+        self.peer_session = None
+        self.expected = 0
+        self.out_of_order = {}
+
+    def update_rto(self, sample):
+        # RFC 6298 smoothing
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+
+class ReliableUDP:
+    # sequence numbers, selective ACKs, NACKs for gaps, retransmission on an
+    # RTT-based timer, duplicate suppression and in-order delivery for every
+    # peer of one socket. Timers sit in a heap; poll() fires the due ones
+    def __init__(self, sock, window=256, max_retries=8):
+        self.sock = sock
+        self.window = window
+        self.max_retries = max_retries
+        self.peers = {}
+        self.timers = []    # (deadline, addr, seq, times sent)
+        self.failed = []    # peers that stopped acknowledging
+        self.lock = threading.Lock()
+        self.counters = {"sent": 0, "retransmits": 0, "acks": 0, "nacks": 0,
+                         "delivered": 0, "duplicates": 0, "failed_peers": 0}
+
+    def send(self, addr, data):
+        with self.lock:
+            peer = self.peers.get(addr)
+            if peer is None:
+                peer = self.peers[addr] = ReliablePeer()
+            peer.closing = False
+            if len(peer.unacked) >= self.window:
+                peer.pending.append(data)
+            else:
+                self.transmit(addr, peer, data)
+
+    def receive(self, addr, packet):
+        # handle one reliable datagram; returns the payloads it makes
+        # deliverable, in order
+        with self.lock:
+            try:
+                magic, kind, session, seq = PACKET_HEADER.unpack_from(packet)
+            except struct.error:
+                return []
+            body = packet[PACKET_HEADER.size:]
+            peer = self.peers.get(addr)
+            if peer is not None:
+                peer.heard = time.monotonic()
+            if kind == DATA_PACKET:
+                if peer is None:
+                    peer = self.peers[addr] = ReliablePeer()
+                return self.on_data(addr, peer, session, seq, body)
+            # acknowledgements for a stream we no longer have are ignored
+            if peer is None or session != peer.session:
+                return []
+            if kind == ACK_PACKET:
+                ranges = [SACK_RANGE.unpack_from(body, i) for i in range(0, len(body) - 7, SACK_RANGE.size)]
+                self.on_ack(addr, peer, seq, ranges)
+            elif kind == NACK_PACKET:
+                missing = [NACK_SEQ.unpack_from(body, i)[0] for i in range(0, len(body) - 3, NACK_SEQ.size)]
+                self.on_ack(addr, peer, seq, ())
+                self.on_nack(addr, peer, missing)
+            return []
+
+    def poll(self):
+        # retransmit whatever has timed out; returns the seconds until the
+        # next timer is due, or None if nothing is waiting for an ACK
+        with self.lock:
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                deadline, addr, seq, sends = heapq.heappop(self.timers)
+                peer = self.peers.get(addr)
+                entry = peer.unacked.get(seq) if peer is not None else None
+                # acknowledged, or resent since this timer was set
+                if entry is None or entry[2] != sends:
+                    continue
+                # one unlucky packet is not enough; the peer must also
+                # have gone quiet
+                if entry[3] >= self.max_retries and now - peer.heard > MAX_RTO:
+                    del self.peers[addr]
+                    if not peer.closing:
+                        self.failed.append(addr)
+                        self.counters["failed_peers"] += 1
+                    continue
+                entry[3] += 1
+                self.retransmit(addr, peer, seq, now)
+            return max(0.0, self.timers[0][0] - now) if self.timers else None
+
+    def take_failed(self):
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def forget(self, addr):
+        # stop tracking addr once what was already sent to it is acknowledged
+        with self.lock:
+            peer = self.peers.get(addr)
+            if peer is None:
+                return
+            if peer.unacked or peer.pending:
+                peer.closing = True
+            else:
+                del self.peers[addr]
+
+    def busy(self):
+        return any(peer.unacked for peer in self.peers.values())
+
+    def drain(self, timeout):
+        # keep handling ACKs until everything sent is acknowledged or timeout passes
+        deadline = time.monotonic() + timeout
+        while self.busy():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            wait = self.poll()
+            readable, _, _ = select.select([self.sock], [], [], remaining if wait is None else min(wait, remaining))
+            if not readable:
+                continue
+            try:
+                packet, addr = self.sock.recvfrom(65535)
+            except OSError:
+                return False
+            if is_reliable_packet(packet):
+                self.receive(addr, packet)
+        return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["peers"] = len(self.peers)
+            stats["in_flight"] = sum(len(peer.unacked) for peer in self.peers.values())
+        return stats
+
+    # the rest expect the lock to be held
+
+    def transmit(self, addr, peer, data):
+        seq = peer.next_seq
+        peer.next_seq += 1
+        packet = PACKET_HEADER.pack(RELIABLE_MAGIC, DATA_PACKET, peer.session, seq) + data
+        now = time.monotonic()
+        peer.unacked[seq] = [packet, now, 1, 0]
+        heapq.heappush(self.timers, (now + peer.rto, addr, seq, 1))
+        self.counters["sent"] += 1
+        self.sendto(packet, addr)
+
+    def retransmit(self, addr, peer, seq, now):
+        entry = peer.unacked[seq]
+        entry[1] = now
+        entry[2] += 1
+        # back off for each timeout in a row so a dead peer is not flooded;
+        # resending on a NACK or SACK hole restarts the plain timer
+        backoff = min(MAX_RTO, peer.rto * 2 ** entry[3])
+        heapq.heappush(self.timers, (now + backoff, addr, seq, entry[2]))
+        self.counters["retransmits"] += 1
+        self.sendto(entry[0], addr)
+
+    def sendto(self, packet, addr):
+        try:
+            self.sock.sendto(packet, addr)
+        except OSError:
+            pass    # the timer will try again
+
+    def on_data(self, addr, peer, session, seq, body):
+        if session != peer.peer_session:
+            if peer.peer_session is not None:
+                # the peer restarted, so what we had in flight to it is moot
+                peer.session = random.getrandbits(32)
+                peer.next_seq = 0
+                peer.unacked.clear()
+                peer.pending.clear()
+            # the peer started a new stream
+            peer.peer_session = session
+            peer.expected = 0
+            peer.out_of_order.clear()
+
+        delivered = []
+        if seq < peer.expected or seq in peer.out_of_order:
+            self.counters["duplicates"] += 1
+        elif seq == peer.expected:
+            delivered.append(body)
+            peer.expected += 1
+            while peer.expected in peer.out_of_order:
+                delivered.append(peer.out_of_order.pop(peer.expected))
+                peer.expected += 1
+        elif seq < peer.expected + 2 * self.window:
+            # a gap: when this packet is the newest so far, ask for what is
+            # missing and far enough behind it not to be merely reordered
+            newest = seq > max(peer.out_of_order, default=peer.expected - 1)
+            peer.out_of_order[seq] = body
+            missing = []
+            if newest:
+                missing = [s for s in range(peer.expected, seq - REORDER_THRESHOLD + 1)
+                           if s not in peer.out_of_order][:64]
+            if missing:
+                nack = PACKET_HEADER.pack(RELIABLE_MAGIC, NACK_PACKET, session, peer.expected)
+                self.sendto(nack + b"".join(NACK_SEQ.pack(s) for s in missing), addr)
+                self.counters["nacks"] += 1
+
+        self.send_ack(addr, peer)
+        self.counters["delivered"] += len(delivered)
+        return delivered
+
+    def send_ack(self, addr, peer):
+        ranges = []
+        for seq in sorted(peer.out_of_order):
+            if ranges and ranges[-1][1] == seq:
+                ranges[-1][1] = seq + 1
+            else:
+                if len(ranges) == 16:
+                    break
+                ranges.append([seq, seq + 1])
+        ack = PACKET_HEADER.pack(RELIABLE_MAGIC, ACK_PACKET, peer.peer_session, peer.expected)
+        self.sendto(ack + b"".join(SACK_RANGE.pack(start, end) for start, end in ranges), addr)
+        self.counters["acks"] += 1
+
+    def on_ack(self, addr, peer, next_expected, ranges):
+        now = time.monotonic()
+        sample = None
+        acked = []
+        while peer.unacked and next(iter(peer.unacked)) < next_expected:
+            acked.append(peer.unacked.popitem(last=False)[1])
+        for start, end in ranges:
+            for seq in range(start, min(end, peer.next_seq)):
+                entry = peer.unacked.pop(seq, None)
+                if entry is not None:
+                    acked.append(entry)
+        for packet, sent_at, sends, timeouts in acked:
+            # Karn: only packets sent once give a clean RTT sample
+            if sends == 1:
+                sample = now - sent_at
+        if sample is not None:
+            peer.update_rto(sample)
+
+        if ranges:
+            # holes well below what the receiver has selectively acknowledged
+            # are lost, so resend them without waiting for their timers
+            highest = max(end for start, end in ranges) - 1
+            holes = takewhile(lambda seq: seq + REORDER_THRESHOLD <= highest, peer.unacked)
+            self.resend_lost(addr, peer, list(holes), now)
+
+        while peer.pending and len(peer.unacked) < self.window:
+            self.transmit(addr, peer, peer.pending.popleft())
+        if peer.closing and not peer.unacked and not peer.pending:
+            del self.peers[addr]
+
+    def on_nack(self, addr, peer, missing):
+        self.resend_lost(addr, peer, missing, time.monotonic())
+
+    def resend_lost(self, addr, peer, seqs, now):
+        # a packet sent less than a round trip ago may only be reordered
+        # (or was already resent), so leave it alone
+        min_age = peer.srtt if peer.srtt is not None else peer.rto
+        for seq in seqs:
+            entry = peer.unacked.get(seq)
+            if entry is not None and now - entry[1] > min_age:
+                entry[3] = 0
+                self.retransmit(addr, peer, seq, now)
+
+
+# history replayed to a UDP client goes out several lines to a datagram,
+# each datagram small enough not to be fragmented on a typical network
+PACKED_DATAGRAM_BYTES = 1400
+
+
+def pack_lines(texts, limit=PACKED_DATAGRAM_BYTES):
+    # newline-joined datagrams of at most limit bytes; a longer line goes alone
+    datagrams = []
+    current = b""
+    for text in texts:
+        data = text.encode()
+        if current and len(current) + 1 + len(data) > limit:
+            datagrams.append(current)
+            current = b""
+        current = current + b"\n" + data if current else data
+    if current:
+        datagrams.append(current)
+    return datagrams
+
+
+# what an idle ClientUDP sends now and then so the server knows it is alive
+HEARTBEAT = "/heartbeat"
+
+
+class TimerWheel:
+    # finds keys not touched for `timeout` seconds. Keys sit in a ring of
+    # slots, one per `tick` seconds. touch() only records the time; when a
+    # key's slot comes round it is either expired or moved to the slot of its
+    # real deadline, so each key costs O(1) per timeout however often it is
+    # touched, and advancing never scans keys that are not due
+    def __init__(self, timeout, tick=1.0):
+        self.timeout = timeout
+        self.tick = tick
+        self.slots = [set() for _ in range(int(timeout / tick) + 2)]
+        self.last_seen = {}
+        self.slot_of = {}
+        self.current = int(time.monotonic() / tick)    # last tick processed
+
+    def touch(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        if key not in self.last_seen:
+            self.place(key, now + self.timeout)
+        self.last_seen[key] = now
+
+    def discard(self, key):
+        if self.last_seen.pop(key, None) is not None:
+            self.slots[self.slot_of.pop(key)].discard(key)
+
+    def expired(self, now=None):
+        # the keys whose timeout has passed, which are no longer tracked
+        now = time.monotonic() if now is None else now
+        expired = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            index = self.current % len(self.slots)
+            due, self.slots[index] = self.slots[index], set()
+            for key in due:
+                deadline = self.last_seen[key] + self.timeout
+                if deadline <= now:
+                    del self.last_seen[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+                else:
+                    self.place(key, deadline)
+        return expired
+
+    def place(self, key, deadline):
+        # never into a slot already passed, or it would wait a whole turn
+        index = max(int(deadline / self.tick), self.current + 1) % len(self.slots)
+        self.slots[index].add(key)
+        self.slot_of[key] = index
+
+    def __len__(self):
+        return len(self.last_seen)
+
+
 class ServerUDP:
-    def __init__(self, server_port):
+    # each channel keeps its last history_size messages (see MessageHistory)
+    # and whoever joins it gets the last `replay` of them.
+    # With flush_window set (in seconds, 0 included) lines for a client are
+    # held for up to that long and go out newline-joined, several to a
+    # datagram of at most PACKED_DATAGRAM_BYTES; None sends each at once.
+    # A client nothing has been heard from for idle_timeout seconds (ClientUDP
+    # sends HEARTBEAT when it has been quiet) is dropped; None keeps everyone
+    def __init__(self, server_port, history_size=100, history_log=None, replay=20, flush_window=None,
+                 idle_timeout=60.0):
         self.server_port = server_port
         self.server_socket = socket(AF_INET, SOCK_DGRAM)
         addr = gethostbyname(gethostname())
         self.server_socket.bind((addr, server_port))
         self.clients = {}
-        self.messages = []
+        self.channels = ChannelDirectory()
+        # (sender, text) of the latest messages, newest last; bounded so a
+        # long-running server does not grow
+        self.messages = deque(maxlen=history_size)
+        self.history = MessageHistory(history_size, history_log)
+        self.replay = replay
+        # clients that speak the reliable protocol get it back; others get plain sendto
+        self.reliable = ReliableUDP(self.server_socket)
+        self.flush_window = flush_window
+        self.outboxes = {}    # client -> lines packed so far
+        self.flush_at = None
+        # run() reads every waiting datagram into this one buffer
+        self.recv_buffer = bytearray(65536)
+        self.io_counters = {"wakeups": 0, "datagrams_in": 0, "datagrams_out": 0, "lines_out": 0}
+        self.idle = TimerWheel(idle_timeout, min(1.0, idle_timeout / 8)) if idle_timeout else None
+        self.idle_evictions = 0
+
+    def send_to(self, client_addr, data):
+        self.io_counters["lines_out"] += 1
+        if self.flush_window is None:
+            self.transmit(client_addr, data)
+            return
+        outbox = self.outboxes.get(client_addr)
+        if outbox is None:
+            self.outboxes[client_addr] = bytearray(data)
+            if self.flush_at is None:
+                self.flush_at = time.monotonic() + self.flush_window
+        elif len(outbox) + 1 + len(data) > PACKED_DATAGRAM_BYTES:
+            # full: send what is there and start the next datagram
+            self.transmit(client_addr, bytes(outbox))
+            outbox[:] = data
+        else:
+            outbox += b"\n"
+            outbox += data
+
+    def transmit(self, client_addr, data):
+        self.io_counters["datagrams_out"] += 1
+        if client_addr in self.reliable.peers:
+            self.reliable.send(client_addr, data)
+        else:
+            self.server_socket.sendto(data, client_addr)
+
+    def flush(self, client_addr=None):
+        # send what is waiting for one client, or for all of them
+        if client_addr is not None:
+            outboxes = [(client_addr, self.outboxes.pop(client_addr, None))]
+        else:
+            outboxes, self.outboxes = self.outboxes.items(), {}
+            self.flush_at = None
+        for addr, outbox in outboxes:
+            if not outbox:
+                continue
+            try:
+                self.transmit(addr, bytes(outbox))
+            except:
+                pass
+
+    def read_ready(self, limit=256):
+        # (client, data) for every datagram already waiting, up to limit, so
+        # one wakeup serves a whole burst
+        ready = []
+        while len(ready) < limit:
+            try:
+                nbytes, client_addr = self.server_socket.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionResetError:    # Windows reports an earlier send that bounced
+                continue
+            if nbytes:
+                ready.append((client_addr, bytes(self.recv_buffer[:nbytes])))
+        self.io_counters["datagrams_in"] += len(ready)
+        return ready
+
+    def evict_idle(self):
+        if self.idle is None:
+            return
+        for client_addr in self.idle.expired():
+            self.idle_evictions += 1
+            # in case it is only quiet, say why it stops hearing from us
+            self.reply(client_addr, "Disconnected: no heartbeat from you for too long")
+            self.close_client(client_addr)
+
+    def get_io_stats(self):
+        stats = dict(self.io_counters)
+        stats["lines_per_datagram"] = stats["lines_out"] / max(1, stats["datagrams_out"])
+        stats["datagrams_per_wakeup"] = stats["datagrams_in"] / max(1, stats["wakeups"])
+        stats["idle_evictions"] = self.idle_evictions
+        return stats
 
     def accept_client(self, client_addr, message):
         try:
             client_name = message.strip()
             if client_name in self.clients.values():
                 try:
-                    self.server_socket.sendto(b"Name already taken", client_addr)
+                    self.send_to(client_addr, b"Name already taken")
                 except:
                     pass
+                self.flush(client_addr)
+                self.reliable.forget(client_addr)
                 return False
 
             self.clients[client_addr] = client_name
+            if self.idle is not None:
+                self.idle.touch(client_addr)
 
             try:
-                self.server_socket.sendto(b"Welcome", client_addr)
+                self.send_to(client_addr, b"Welcome")
             except:
                 del self.clients[client_addr]
                 return False
 
+            self.send_history(client_addr, DEFAULT_CHANNEL)
+            self.channels.join(client_addr, client_name, DEFAULT_CHANNEL)
             join_msg = f"User {client_name} joined"
             self.messages.append((client_addr, join_msg))
             self.broadcast()
@@ -352,30 +1370,34 @@ class ServerUDP:
 
             client_name = self.clients[client_addr]
             del self.clients[client_addr]
-
-            dc_msg = f"User {client_name} left"
-            self.messages.append((client_addr, dc_msg))
-            self.broadcast()
+            if self.idle is not None:
+                self.idle.discard(client_addr)
+            self.flush(client_addr)
+            self.reliable.forget(client_addr)
+
+            for channel in self.channels.leave_all(client_addr):
+                dc_msg = f"{channel_prefix(channel)}User {client_name} left"
+                self.messages.append((client_addr, dc_msg))
+                self.broadcast(channel)
             return True
         except Exception:
             return False
 
-    def broadcast(self):
+    def broadcast(self, channel=DEFAULT_CHANNEL):
+        # send the latest message to the members of channel
         try:
             if not self.messages:
-                return lsit(self.clients.keys())
+                return list(self.clients.keys())
+            # close_client removes departing clients; a "left" notice here may
+            # only mean the sender left this one channel
             sender_addr, msg = self.messages[-1]
             data = msg.encode()
 
-            if msg.startswith("User ") and msg.endswith(" left"):
-                if sender_addr in self.clients:
-                    del self.clients[sender_addr]
-
-            for addr in list(self.clients.keys()):
+            for addr, name in self.channels.members(channel):
                 if addr == sender_addr:
                     continue
                 try:
-                    self.server_socket.sendto(data, addr)
+                    self.send_to(addr, data)
                 except:
                     pass
             return list(self.clients.keys())
@@ -385,57 +1407,141 @@ class ServerUDP:
     def shutdown(self):
         try:
             msg = b"server-shutdown"
+            # what is still waiting goes first; the notice goes in a datagram of its own
+            self.flush()
             for addr in list(self.clients.keys()):
                 try:
-                    self.server_socket.sendto(msg, addr)
+                    self.transmit(addr, msg)
                 except:
                     pass
                 self.close_client(addr)
+            self.flush()
+            # give reliable clients a moment to acknowledge the shutdown
+            self.reliable.drain(1.0)
 
             try:
                 self.server_socket.close()
             except:
                 pass
+            self.history.close()
         except Exception:
             pass
 
     def get_clients_number(self):
         return len(self.clients)
 
-    def run(self):
-        print("UDP Server start. Press Ctrl+C to stop.")
+    def handle_command(self, client_addr, command, channel):
+        client_name = self.clients[client_addr]
+        replay_channel = None
+        if command == "join":
+            if channel is None:
+                self.reply(client_addr, "Usage: /join <channel>")
+                return
+            if self.channels.join(client_addr, client_name, channel):
+                self.messages.append((client_addr, f"{channel_prefix(channel)}User {client_name} joined"))
+                self.broadcast(channel)
+                # a newcomer catches up on the channel after the reply
+                replay_channel = channel
+            size = self.channels.size(channel)
+            reply = f"Now talking in #{channel} ({size} member{'' if size == 1 else 's'})"
+        else:
+            channel = channel or self.channels.current(client_addr)
+            if channel is not None and self.channels.leave(client_addr, channel):
+                self.messages.append((client_addr, f"{channel_prefix(channel)}User {client_name} left"))
+                self.broadcast(channel)
+                current = self.channels.current(client_addr)
+                reply = f"Left #{channel}; now talking in #{current}" if current else f"Left #{channel}"
+            else:
+                reply = f"You are not in #{channel}" if channel else "You are not in a channel"
+        self.reply(client_addr, reply)
+        if replay_channel is not None:
+            self.send_history(client_addr, replay_channel)
 
+    def reply(self, client_addr, text):
         try:
-            while True:
-                try:
-                    readable, _, _ = select.select([self.server_socket], [], [], 0.5)
-                    if not readable:
-                        continue
-                    data, client_addr = self.server_socket.recvfrom(1024)
-                    if not data:
-                        continue
+            self.send_to(client_addr, text.encode())
+        except:
+            pass
 
-                    msg = data.decode().strip()
+    def send_history(self, client_addr, channel):
+        if not self.replay:
+            return
+        for datagram in pack_lines(self.history.recent(channel, self.replay)):
+            try:
+                self.send_to(client_addr, datagram)
+            except:
+                pass
 
-                    name_part = None
-                    text_part = msg
-                    if ":" in msg:
-                        name_part, text_part = msg.split(":", 1)
+    def handle_datagram(self, client_addr, data):
+        msg = data.decode().strip()
 
-                    text_part = text_part.strip()
+        name_part = None
+        text_part = msg
+        if ":" in msg:
+            name_part, text_part = msg.split(":", 1)
 
-                    if text_part == "join":
-                        client_name = name_part if name_part else text_part
-                        self.accept_client(client_addr, client_name)
-                        continue
+        text_part = text_part.strip()
 
-                    if text_part == "exit":
-                        self.close_client(client_addr)
-                        continue
+        if text_part == "join":
+            client_name = name_part if name_part else text_part
+            self.accept_client(client_addr, client_name)
+            return
+
+        if text_part == "exit":
+            self.close_client(client_addr)
+            return
+
+        if text_part == HEARTBEAT:
+            return    # run() has already noted that the client is alive
+
+        if client_addr in self.clients:
+            command = parse_channel_command(text_part)
+            if command is not None:
+                self.handle_command(client_addr, *command)
+                return
+            # messages go to the sender's current channel
+            channel = self.channels.current(client_addr)
+            if channel is None:
+                self.reply(client_addr, "You are not in a channel; /join one to talk")
+                return
+            msg = f"{channel_prefix(channel)}{self.clients[client_addr]}: {text_part}"
+            self.messages.append((client_addr, msg))
+            self.history.add(channel, msg)
+            self.broadcast(channel)
+
+    def run(self):
+        print("UDP Server start. Press Ctrl+C to stop.")
 
-                    if client_addr in self.clients:
-                        self.messages.append((client_addr, f"{self.clients[client_addr]}: {text_part}"))
-                        self.broadcast()
+        self.server_socket.setblocking(False)
+        try:
+            while True:
+                try:
+                    # wake for the next retransmission or flush as well as for input
+                    wait = self.reliable.poll()
+                    for client_addr in self.reliable.take_failed():
+                        self.close_client(client_addr)
+                    self.evict_idle()
+                    timeout = 0.5 if wait is None else min(wait, 0.5)
+                    if self.flush_at is not None:
+                        timeout = max(0.0, min(timeout, self.flush_at - time.monotonic()))
+                    readable, _, _ = select.select([self.server_socket], [], [], timeout)
+                    if readable:
+                        self.io_counters["wakeups"] += 1
+                        now = time.monotonic()
+                        for client_addr, data in self.read_ready():
+                            # any datagram, an ACK included, shows the client is alive
+                            if self.idle is not None and client_addr in self.clients:
+                                self.idle.touch(client_addr, now)
+                            try:
+                                if is_reliable_packet(data):
+                                    for payload in self.reliable.receive(client_addr, data):
+                                        self.handle_datagram(client_addr, payload)
+                                else:
+                                    self.handle_datagram(client_addr, data)
+                            except Exception:
+                                continue
+                    if self.flush_at is not None and time.monotonic() >= self.flush_at:
+                        self.flush()
 
                 except KeyboardInterrupt:
                     break
@@ -447,29 +1553,34 @@ class ServerUDP:
 
 
 class ClientUDP:
-    def __init__(self, client_name, server_port):
+    # reliable=True sends through ReliableUDP, so messages survive packet
+    # loss and arrive in order; the server answers in kind. After
+    # heartbeat_interval seconds without sending anything the client sends
+    # HEARTBEAT, so the server does not take it for gone
+    def __init__(self, client_name, server_port, reliable=False, heartbeat_interval=15.0):
         self.client_socket = socket(AF_INET, SOCK_DGRAM)
         self.server_addr = gethostbyname(gethostname())
         self.server_port = server_port
         self.client_name = client_name
         self.exit_run = threading.Event()
         self.exit_receive = threading.Event()
+        self.reliable = ReliableUDP(self.client_socket) if reliable else None
+        self.pending = deque()
+        self.heartbeat_interval = heartbeat_interval
+        self.last_sent = time.monotonic()
 
     def connect_server(self):
         try:
             self.send("join")
-            self.client_socket.settimeout(2.0)
-            try:
-                data, addr = self.client_socket.recvfrom(1024)
-            except timeout:
-                print("No response from server")
-                return False
-
-            if not data:
-                print("No response data from server.")
-                return False
-
-            msg = data.decode().strip()
+            deadline = time.monotonic() + 2.0
+            while not self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("No response from server")
+                    return False
+                self.read_datagrams(remaining)
+
+            msg = self.pending.popleft().decode().strip()
             if "Welcome" in msg:
                 print(msg)
                 return True
@@ -479,16 +1590,36 @@ class ClientUDP:
         except Exception as e:
             print(f"Connection error (UDP): {e}")
             return False
-        finally:
-            try:
-                self.client_socket.settimeout(None)
-            except:
-                pass
+
+    def read_datagrams(self, wait):
+        # wait up to `wait` seconds for a datagram and queue what it delivers;
+        # in reliable mode this also runs the retransmission timers
+        if self.reliable is not None:
+            due = self.reliable.poll()
+            if due is not None:
+                wait = min(wait, due)
+            if self.reliable.take_failed():
+                raise ConnectionResetError("server stopped acknowledging")
+        readability, _, _ = select.select([self.client_socket], [], [], wait)
+        if not readability:
+            return
+        data, addr = self.client_socket.recvfrom(65535)
+        if self.reliable is not None and is_reliable_packet(data):
+            payloads = self.reliable.receive(addr, data)
+        else:
+            payloads = [data] if data else []
+        # the server may pack several lines into one datagram
+        for payload in payloads:
+            self.pending.extend(payload.split(b"\n"))
 
     def send(self, text):
         try:
             msg = f"{self.client_name}: {text}"
-            self.client_socket.sendto(msg.encode(), (self.server_addr, self.server_port))
+            self.last_sent = time.monotonic()
+            if self.reliable is not None:
+                self.reliable.send((self.server_addr, self.server_port), msg.encode())
+            else:
+                self.client_socket.sendto(msg.encode(), (self.server_addr, self.server_port))
         except Exception as e:
             print(f"Send error (UDP): {e}")
             self.exit_run.set()
@@ -497,15 +1628,13 @@ class ClientUDP:
     def receive(self):
         while not self.exit_receive.is_set():
             try:
-                readability, _, _ = select.select([self.client_socket], [], [], 0.5)
-                if not readability:
+                if not self.pending:
+                    if self.heartbeat_interval and time.monotonic() - self.last_sent >= self.heartbeat_interval:
+                        self.send(HEARTBEAT)
+                    self.read_datagrams(0.5)
                     continue
 
-                data, addr = self.client_socket.recvfrom(1024)
-                if not data:
-                    continue
-
-                msg = data.decode().strip()
+                msg = self.pending.popleft().decode().strip()
 
                 if msg == "server-shutdown":
                     print("Server is shutting down.")
@@ -549,9 +1678,13 @@ class ClientUDP:
                 else:
                     self.send(user_input)
         finally:
+            self.exit_run.set()
+            self.exit_receive.set()
+            if self.reliable is not None:
+                # make sure the server hears "exit" before the socket goes
+                recv_thread.join(1.0)
+                self.reliable.drain(1.0)
             try:
                 self.client_socket.close()
             except:
                 pass
-            self.exit_run.set()
-            self.exit_receive.set()
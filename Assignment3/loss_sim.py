@@ -0,0 +1,285 @@
+"""
+Author: Everett Guyea
+Date: 18-10-2026
+
+Loss and latency simulation for the UDP chatroom. A relay sits between
+simulated ClientUDP-style clients and a ServerUDP process and drops each
+datagram at random, the way UDPPingerServer.py does (its randint(0, 10) < 4
+is a loss of 4/11), after adding delay and jitter. One sender broadcasts
+timestamped messages to the receivers, once with plain datagrams and once
+through ReliableUDP, and the table shows delivery, goodput and latency.
+"""
+
+from socket import *
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from chatroom import ReliableUDP, is_reliable_packet
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the UDP chat under simulated packet loss")
+    parser.add_argument("--loss", default="0,0.1,0.364",
+                        help="comma-separated drop probabilities (default 0,0.1,0.364 = UDPPingerServer's 4/11)")
+    parser.add_argument("--messages", type=int, default=500, help="messages sent (default 500)")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second (default 200)")
+    parser.add_argument("--receivers", type=int, default=3, help="receiving clients (default 3)")
+    parser.add_argument("--delay", type=float, default=0.005, help="one-way delay in seconds (default 0.005)")
+    parser.add_argument("--jitter", type=float, default=0.005,
+                        help="extra random delay in seconds, which also reorders packets (default 0.005)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the relay (default 1)")
+    parser.add_argument("--port", type=int, default=12500, help="first server port to use (default 12500)")
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages at {args.rate:g}/s to {args.receivers} receivers, "
+          f"delay {args.delay * 1000:g} ms + up to {args.jitter * 1000:g} ms jitter\n")
+    print(f"{'mode':<10}{'loss':>6}{'delivered':>11}{'dups':>6}{'reord':>7}{'goodput/s':>11}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'resent':>8}")
+    port = args.port
+    for loss in (float(value) for value in args.loss.split(",")):
+        for mode in ("plain", "reliable"):
+            r = simulate(mode == "reliable", loss, args, port)
+            port += 1
+            print(f"{mode:<10}{loss:>6.2f}{r['delivered']:>10.1f}%{r['duplicates']:>6}{r['reordered']:>7}"
+                  f"{r['goodput']:>11.1f}{r['p50']:>9.1f}{r['p95']:>9.1f}{r['p99']:>9.1f}{r['retransmits']:>8}")
+
+
+class LossyRelay(threading.Thread):
+    # forwards datagrams between clients and the server, dropping and
+    # delaying them; each client gets its own socket toward the server so
+    # the server still sees one address per client
+    def __init__(self, server_addr, loss, delay, jitter, rng):
+        super().__init__(daemon=True)
+        self.server_addr = server_addr
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = rng
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.upstream = {}    # client address -> socket toward the server
+        self.queue = []       # (send at, tiebreak, socket, data, destination)
+        self.order = itertools.count()
+        self.stopped = threading.Event()
+        self.forwarded = 0
+        self.dropped = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self.queue)
+                sock.sendto(data, addr)
+            wait = min(0.05, self.queue[0][0] - now) if self.queue else 0.05
+            for key, _ in self.selector.select(max(wait, 0)):
+                data, addr = key.fileobj.recvfrom(65535)
+                if key.data is None:
+                    # client -> server
+                    up = self.upstream.get(addr)
+                    if up is None:
+                        up = self.upstream[addr] = socket(AF_INET, SOCK_DGRAM)
+                        self.selector.register(up, selectors.EVENT_READ, addr)
+                    self.schedule(up, data, self.server_addr)
+                else:
+                    # server -> client
+                    self.schedule(self.sock, data, key.data)
+
+    def schedule(self, sock, data, addr):
+        if self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        send_at = time.monotonic() + self.delay + self.rng.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (send_at, next(self.order), sock, data, addr))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+class SimClient:
+    # one chat client speaking the ClientUDP protocol, plain or reliable
+    def __init__(self, name, relay_addr, reliable):
+        self.name = name
+        self.relay_addr = relay_addr
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.reliable = ReliableUDP(self.sock) if reliable else None
+        self.joined = False
+        self.latencies = {}    # message number -> seconds
+        self.duplicates = 0
+        self.reordered = 0
+        self.highest = -1
+        self.last_delivery = None
+
+    def send(self, text):
+        data = f"{self.name}: {text}".encode()
+        if self.reliable is not None:
+            self.reliable.send(self.relay_addr, data)
+        else:
+            self.sock.sendto(data, self.relay_addr)
+
+    def on_readable(self):
+        data, addr = self.sock.recvfrom(65535)
+        if self.reliable is not None and is_reliable_packet(data):
+            payloads = self.reliable.receive(addr, data)
+        else:
+            payloads = [data]
+        for payload in payloads:
+            for line in payload.decode().split("\n"):
+                self.handle(line, time.time())
+
+    def handle(self, msg, now):
+        if msg == "Welcome":
+            self.joined = True
+            return
+        # "sender: t=<send time> n=<number>"
+        _, _, text = msg.partition(": ")
+        if not text.startswith("t="):
+            return
+        sent, number = text.split()
+        n = int(number[2:])
+        if n in self.latencies:
+            self.duplicates += 1
+            return
+        if n < self.highest:
+            self.reordered += 1
+        self.highest = max(self.highest, n)
+        self.latencies[n] = now - float(sent[2:])
+        self.last_delivery = time.monotonic()
+
+    def timer_wait(self):
+        return self.reliable.poll() if self.reliable is not None else None
+
+
+def simulate(reliable, loss, args, port):
+    server = start_server(port)
+    relay = LossyRelay((gethostbyname(gethostname()), port), loss, args.delay, args.jitter,
+                       random.Random(args.seed))
+    relay.start()
+    receivers = [SimClient(f"r{i}", relay.address, reliable) for i in range(args.receivers)]
+    sender = SimClient("sender", relay.address, reliable)
+    clients = receivers + [sender]
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client.sock, selectors.EVENT_READ, client)
+
+    result = None
+
+    def pump(seconds):
+        wait = seconds
+        for client in clients:
+            due = client.timer_wait()
+            if due is not None:
+                wait = min(wait, due)
+        for key, _ in selector.select(wait):
+            key.data.on_readable()
+
+    try:
+        # join everyone; plain clients simply ask again until welcomed, and a
+        # reliable join backs off like any other packet, so allow it longer
+        deadline = time.monotonic() + 30
+        asked = {}
+        while not all(client.joined for client in clients) and time.monotonic() < deadline:
+            for client in clients:
+                last = asked.get(client)
+                if not client.joined and (last is None or (not reliable and time.monotonic() - last > 0.3)):
+                    client.send("join")
+                    asked[client] = time.monotonic()
+            pump(0.01)
+
+        # send at the configured rate while receiving
+        start = time.monotonic()
+        for n in range(args.messages):
+            send_at = start + n / args.rate
+            while time.monotonic() < send_at:
+                pump(max(0.0, send_at - time.monotonic()))
+            sender.send(f"t={time.time():.6f} n={n}")
+
+        # give stragglers and retransmissions time to arrive
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if all(len(r.latencies) == args.messages for r in receivers):
+                break
+            pump(0.01)
+        settle = time.monotonic() + 0.3
+        while time.monotonic() < settle and reliable and any(c.reliable.busy() for c in clients):
+            pump(0.01)
+        # goodput counts up to the last message that made it
+        elapsed = max((r.last_delivery for r in receivers if r.last_delivery), default=time.monotonic()) - start
+
+        latencies = sorted(latency for r in receivers for latency in r.latencies.values())
+        delivered = sum(len(r.latencies) for r in receivers)
+        result = {
+            "delivered": 100.0 * delivered / (args.messages * len(receivers)),
+            "duplicates": sum(r.duplicates for r in receivers),
+            "reordered": sum(r.reordered for r in receivers),
+            "goodput": delivered / len(receivers) / elapsed,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "client_retransmits": sum(c.reliable.stats()["retransmits"] for c in clients) if reliable else 0,
+        }
+    finally:
+        for client in clients:
+            client.sock.close()
+        selector.close()
+        relay.stop()
+        server_stats = stop_server(server)
+        if result is not None:
+            result["retransmits"] = result.pop("client_retransmits") + server_stats.get("retransmits", 0)
+    return result
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, -(-p * len(values) // 100) - 1)]
+
+
+# Helper function to run ServerUDP in its own process; it prints its
+# reliability counters as JSON once stopped
+def start_server(port):
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = (f"import chatroom, json; server = chatroom.ServerUDP({port}); server.run(); "
+            f"print(json.dumps(server.reliable.stats()))")
+    server = subprocess.Popen([sys.executable, "-c", code], cwd=here,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    time.sleep(0.5)
+    return server
+
+
+def stop_server(server):
+    # Ctrl+C lets the server send its shutdown notice and close cleanly
+    server.send_signal(signal.SIGINT)
+    try:
+        output, _ = server.communicate(timeout=5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+        return {}
+    lines = output.strip().splitlines()
+    try:
+        return json.loads(lines[-1]) if lines else {}
+    except ValueError:
+        return {}
+
+
+if __name__ == "__main__":
+    main()